@@ -1,9 +1,14 @@
 import sys
+import time
 import argparse
 import collections
-from itertools import izip
+import multiprocessing
+from itertools import imap
 
 from parsing import parse_fasta_mhc_dirs
+from seq_helpers import best_start_offset, group_by_sequence
+from alignment_cache import AlignmentCache
+from reference_index import KmerReferenceIndex
 
 import numpy as np
 from pepdata import amino_acid
@@ -49,12 +54,62 @@ parser.add_argument(
     help="File containing BLOSUM matrix coefficients"
 )
 
+parser.add_argument(
+    "--method",
+    default="dp",
+    choices=["dp", "greedy"],
+    help="Find optimal deletions with dynamic programming or delete "
+         "one window at a time (the older, slower greedy search)"
+)
+
+parser.add_argument(
+    "--reference-panel",
+    type=str,
+    default="",
+    help="Comma separated alleles to use as alternative references, each "
+         "sequence is aligned to whichever is most similar (by k-mer "
+         "sketch) and the result mapped onto --reference-allele"
+)
+
+parser.add_argument(
+    "--kmer-size",
+    type=int,
+    default=3,
+    help="Length of k-mers used to choose among --reference-panel alleles"
+)
+
+parser.add_argument(
+    "--cache-file",
+    default=None,
+    help="SQLite file of previous alignments to reuse (created if missing)"
+)
+
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=1,
+    help="Number of processes to parse and align sequences with"
+)
+
+parser.add_argument(
+    "--seqs-cache-dir",
+    default=None,
+    help="Directory for caching parsed sequences between runs"
+)
+
 class Aligner(object):
 
+    # increment whenever a change to the alignment code changes its results
+    VERSION = 1
+
     def __init__(
             self,
             coefficient_matrix="blosum50",
-            exact_match_bonus = 0):
+            exact_match_bonus = 0,
+            method = "dp"):
+        self.method = method
+        self.coefficient_matrix = coefficient_matrix
+        self.exact_match_bonus = exact_match_bonus
         self.coeffs = getattr(amino_acid, coefficient_matrix)
         self.nested_coeffs_dict = {}
         for k,v in self.coeffs.iteritems():
@@ -65,58 +120,192 @@ class Aligner(object):
                 v += exact_match_bonus
             self.nested_coeffs_dict[x][y] = v
 
+        # same coefficients as a 2D array indexed by residue numbers
+        self.letters = sorted(self.nested_coeffs_dict.keys())
+        self.letter_indices = dict(
+            (letter, i) for (i, letter) in enumerate(self.letters))
+        self.coeff_matrix = np.array([
+            [self.nested_coeffs_dict[x][y] for y in self.letters]
+            for x in self.letters
+        ], dtype=float)
+
+    def description(self, maxdels_per_iter=50):
+        """
+        String identifying everything which affects alignment results
+        """
+        desc = "Aligner-v%d:%s:%s:bonus=%s" % (
+            self.VERSION,
+            self.method,
+            self.coefficient_matrix,
+            self.exact_match_bonus)
+        if self.method == "greedy":
+            desc += ":maxdels=%d" % maxdels_per_iter
+        return desc
+
+    def encode(self, seq):
+        """
+        Convert a string of residues into an array of residue numbers
+        """
+        return np.array([self.letter_indices[x] for x in seq], dtype=int)
+
     def align(self, ref, seq, maxdels_per_iter=50):
         """
-        Delete positions from seq one at a time until same length as ref
+        Delete positions from seq until it's the same length as ref
         """
-        n = len(ref)
+        positions = self.aligned_positions(ref, seq, maxdels_per_iter)
+        return "".join(seq[i] for i in positions)
 
+    def aligned_positions(self, ref, seq, maxdels_per_iter=50):
+        """
+        Positions of seq which are kept (aligned to each position of ref)
+        """
+        if self.method == "dp":
+            return self.dp_positions(ref, seq)
+        elif self.method == "greedy":
+            return self.greedy_positions(ref, seq, maxdels_per_iter)
+        else:
+            raise ValueError("Unknown alignment method: %s" % self.method)
+
+    def align_dp(self, ref, seq):
+        return "".join(seq[i] for i in self.dp_positions(ref, seq))
+
+    def align_greedy(self, ref, seq, maxdels_per_iter=50):
+        return "".join(
+            seq[i] for i in self.greedy_positions(ref, seq, maxdels_per_iter))
+
+    def dp_positions(self, ref, seq):
+        """
+        Delete len(seq) - len(ref) positions from seq so that the total
+        substitution score against ref is as large as possible, returns
+        the positions which are kept.
+
+        Uses dynamic programming over (ref position, number of deletions so
+        far), each row of the table is a running maximum over deletions.
+        """
+        n = len(ref)
         assert len(seq) >= n, (ref, seq, len(ref), len(seq))
-        n_extra = n - len(seq)
+        n_dels = len(seq) - n
 
-        coeffs = self.nested_coeffs_dict
+        ref_idx = self.encode(ref)
+        seq_idx = self.encode(seq)
+        # scores[i, d] = score of seq[i + d] aligned with ref[i]
+        windows = seq_idx[
+            np.arange(n)[:, np.newaxis] + np.arange(n_dels + 1)]
+        scores = self.coeff_matrix[windows, ref_idx[:, np.newaxis]]
+
+        # best[i, d] = best score for ref[:i+1] with at most d deletions
+        # before the residue aligned to ref[i]
+        best = np.empty((n, n_dels + 1), dtype=float)
+        best[0] = np.maximum.accumulate(scores[0])
+        for i in xrange(1, n):
+            best[i] = np.maximum.accumulate(best[i - 1] + scores[i])
+
+        # walk back choosing the position each ref residue was aligned to,
+        # preferring the largest number of deletions among ties
+        kept = np.empty(n, dtype=int)
+        d = n_dels
+        for i in xrange(n - 1, -1, -1):
+            candidates = scores[i, :d + 1].copy()
+            if i > 0:
+                candidates += best[i - 1, :d + 1]
+            d = d - np.argmax(candidates[::-1] == best[i, d])
+            kept[i] = i + d
+        return kept
+
+    def greedy_positions(self, ref, seq, maxdels_per_iter=50):
+        """
+        Delete positions from seq one at a time until same length as ref,
+        returns the positions which are kept.
+        """
+        n = len(ref)
+
+        assert len(seq) >= n, (ref, seq, len(ref), len(seq))
 
         # choose best start position (trimming off large insertions at the
         # beginning of the sequence
-        best_score = 0
-        aligned = seq
-        print "ref", ref
-        print "seq", aligned
-        for i in xrange(len(seq) - len(ref) + 1):
-            candidate = seq[i:]
-            n_matches = sum(x==y for (x,y) in izip(candidate, ref))
-            print i, n_matches
-            if n_matches > best_score:
-                best_score = n_matches
-                aligned = candidate
+        offset = best_start_offset(seq, ref)
+        positions = np.arange(offset, len(seq))
 
         # after a hopefully faster first phase of getting rid of a
         # non-matching prefix, follow up with approximate-match iterative
         # deletions until same length as reference
-        while len(aligned) > n:
-            # choose a range of positions to delete
-            best = None
-            best_score = -np.inf
-            best_score_len = 0
-            best_i = 0
-            best_j = 0
-            for i in xrange(len(aligned)):
-                maxdels = min(len(aligned) - len(ref), maxdels_per_iter)
-                for j in xrange(i+1, min(len(aligned), i+maxdels+1)):
-                    candidate = aligned[:i] + aligned[j:]
-                    score = sum(coeffs[x][y] for (x,y) in izip(candidate, ref))
-                    delsize = j - i
-                    if score > best_score:
-                        best = candidate
-                        best_score = score
-                        best_score_len = delsize
-                    elif score == best_score and delsize  > best_score_len:
-                        best = candidate
-                        best_score = score
-                        best_score_len = delsize
-            aligned = best
-
-        return aligned
+        ref_idx = self.encode(ref)
+        aligned_idx = self.encode(seq[offset:])
+        while len(aligned_idx) > n:
+            i, j = self.best_deletion(ref_idx, aligned_idx, maxdels_per_iter)
+            aligned_idx = np.concatenate([aligned_idx[:i], aligned_idx[j:]])
+            positions = np.concatenate([positions[:i], positions[j:]])
+        return positions
+
+    def best_deletion(self, ref_idx, aligned_idx, maxdels_per_iter=50):
+        """
+        Find the window [i, j) of aligned_idx whose deletion gives the best
+        score against ref_idx (both arrays of residue numbers). Ties go to
+        larger deletions and then to windows which start earlier.
+
+        Every candidate window is scored at once: the part of the sequence
+        before the window is scored by prefix sums of the unshifted
+        residues, the part after by suffix sums of residues shifted left
+        by the window size.
+        """
+        n = len(ref_idx)
+        n_aligned = len(aligned_idx)
+        max_dels = min(n_aligned - n, maxdels_per_iter)
+        coeffs = self.coeff_matrix
+
+        prefix = np.zeros(n + 1)
+        np.cumsum(coeffs[aligned_idx[:n], ref_idx], out=prefix[1:])
+
+        # shifted[d - 1, k] = score of aligned[k + d] against ref[k]
+        del_sizes = np.arange(1, max_dels + 1)
+        shifted = coeffs[
+            aligned_idx[np.arange(n) + del_sizes[:, np.newaxis]], ref_idx]
+        suffix = np.zeros((max_dels, n + 1))
+        suffix[:, :n] = np.cumsum(shifted[:, ::-1], axis=1)[:, ::-1]
+
+        # windows starting past the end of ref keep the whole scored prefix
+        starts = np.minimum(np.arange(n_aligned), n)
+        scores = prefix[starts] + suffix[:, starts]
+        # windows can't run off the end of the sequence
+        too_long = \
+            np.arange(n_aligned) + del_sizes[:, np.newaxis] > n_aligned - 1
+        scores[too_long] = -np.inf
+
+        best_mask = scores == scores.max()
+        d = np.nonzero(best_mask.any(axis=1))[0][-1]
+        i = np.argmax(best_mask[d])
+        return i, i + del_sizes[d]
+
+
+# aligner and reference panel used by each worker process
+_worker_aligner = None
+_worker_panel_seqs = None
+_worker_panel_positions = None
+
+def init_worker(coefficient_matrix, method, panel_seqs, panel_positions):
+    """
+    Create the aligner and reference panel used by `align_allele` in this
+    process. `panel_positions` gives the positions of each panel sequence
+    which are aligned to the main reference.
+    """
+    global _worker_aligner, _worker_panel_seqs, _worker_panel_positions
+    _worker_aligner = Aligner(coefficient_matrix, method=method)
+    _worker_panel_seqs = panel_seqs
+    _worker_panel_positions = panel_positions
+
+def align_allele(allele_seq_and_panel_name):
+    """
+    Align an allele's sequence against the chosen panel reference and map
+    the result onto the main reference, returns allele, aligned sequence
+    and number of seconds it took
+    """
+    allele, seq, panel_name = allele_seq_and_panel_name
+    start_time = time.time()
+    positions = _worker_aligner.aligned_positions(
+        _worker_panel_seqs[panel_name], seq)
+    aligned_seq = "".join(
+        seq[positions[i]] for i in _worker_panel_positions[panel_name])
+    return allele, aligned_seq, time.time() - start_time
 
 
 if __name__ == '__main__':
@@ -129,35 +318,125 @@ if __name__ == '__main__':
     seqs = parse_fasta_mhc_dirs(
         [args.dir],
         exclude_allele_substrings=exclude_alleles,
-        require_allele_substrings=require_substrings)
+        require_allele_substrings=require_substrings,
+        processes=args.jobs,
+        cache_dir=args.seqs_cache_dir)
     assert args.reference_allele in seqs, seqs.keys()
     ref = seqs[args.reference_allele]
 
     print "Reference", ref
     print "Length", len(ref)
 
-    aligned = collections.OrderedDict()
-    aligner = Aligner(args.coeff_matrix)
-
+    to_align = []
     for allele in sorted(seqs.keys()):
         seq = seqs[allele]
-        if allele != "Mane-A4*01:03":
-            continue
         if len(seq) < len(ref):
             print "Skipping %s (len=%d)" % (allele, len(seq))
         elif any(c in seq for c in ("X", "Z", "B", "J")):
             print "Incomplete sequence for %s" % allele
         else:
-            print ">", allele
-            aligned_seq = aligner.align(ref, seq)
+            to_align.append((allele, seq))
+
+    # many alleles share a protein sequence, only align each one once
+    distinct_seqs, seq_alleles = group_by_sequence(to_align)
+    print "%d alleles, %d distinct sequences (%0.2fx dedup)" % (
+        len(to_align),
+        len(distinct_seqs),
+        len(to_align) / float(max(len(distinct_seqs), 1)))
+
+    # each panel allele is aligned to the main reference once, sequences
+    # aligned against a panel allele get mapped through that alignment
+    aligner = Aligner(args.coeff_matrix, method=args.method)
+    panel_names = [args.reference_allele] + [
+        allele for allele in args.reference_panel.split(",") if allele]
+    panel_seqs = {}
+    panel_positions = {}
+    for name in panel_names:
+        assert name in seqs, "Panel allele %s not found" % name
+        if len(seqs[name]) < len(ref):
+            print "Skipping panel allele %s (len=%d)" % (name, len(seqs[name]))
+            continue
+        panel_seqs[name] = seqs[name]
+        panel_positions[name] = aligner.aligned_positions(ref, seqs[name])
+    index = KmerReferenceIndex(panel_seqs, k=args.kmer_size)
+    seq_panel_names = dict(
+        (seq, index.nearest(seq, max_length=len(seq)))
+        for seq in distinct_seqs)
+    panel_counts = collections.Counter(seq_panel_names.values())
+    for name in sorted(panel_counts.keys()):
+        print "Reference %s: %d sequences" % (name, panel_counts[name])
+
+    def cache_ref(seq):
+        """
+        Reference part of the cache key, includes the panel allele used
+        """
+        panel_name = seq_panel_names[seq]
+        if panel_name == args.reference_allele:
+            return ref
+        return ref + "/" + panel_seqs[panel_name]
+
+    cache = None
+    aligned_by_seq = {}
+    if args.cache_file:
+        cache = AlignmentCache(args.cache_file, aligner.description())
+        for seq in distinct_seqs:
+            aligned_seq = cache.get(cache_ref(seq), seq)
+            if aligned_seq is not None:
+                aligned_by_seq[seq] = aligned_seq
+        print cache.summary()
+    not_cached = [
+        (seq_alleles[seq][0], seq, seq_panel_names[seq])
+        for seq in distinct_seqs
+        if seq not in aligned_by_seq
+    ]
+
+    start_time = time.time()
+    worker_args = (args.coeff_matrix, args.method, panel_seqs, panel_positions)
+    pool = None
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(
+            args.jobs, initializer=init_worker, initargs=worker_args)
+        # imap yields results in the same (sorted) order as the inputs
+        new_results = pool.imap(align_allele, not_cached)
+    else:
+        init_worker(*worker_args)
+        new_results = imap(align_allele, not_cached)
+
+    def all_results():
+        """
+        Merge cached, new and shared alignments, keeping sorted allele order
+        """
+        for allele, seq in to_align:
+            if seq in aligned_by_seq:
+                yield allele, aligned_by_seq[seq], 0.0
+            else:
+                _, aligned_seq, elapsed = next(new_results)
+                aligned_by_seq[seq] = aligned_seq
+                if cache is not None:
+                    cache.put(cache_ref(seq), seq, aligned_seq)
+                yield allele, aligned_seq, elapsed
+
+    with open(args.output_file, 'w') as f:
+        for allele, aligned_seq, elapsed in all_results():
+            print ">", allele, "(%0.3fs)" % elapsed
             mismatch = "".join(
                 x if x != y else "_" for (x,y) in zip(aligned_seq,ref)
             )
             print mismatch
             assert len(aligned_seq) == len(ref)
-            aligned[allele] = aligned_seq
+            f.write(">%s\n%s\n" % (allele, aligned_seq))
+            f.flush()
 
-    with open(args.output_file, 'w') as f:
-        for allele, seq in aligned.iteritems():
-            f.write(">%s\n%s\n" % (allele, seq))
-            f.flush()
\ No newline at end of file
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if cache is not None:
+        cache.close()
+
+    total_time = time.time() - start_time
+    print "Aligned %d sequences in %0.2fs (%0.2f sequences/sec, %d jobs)" % (
+        len(not_cached),
+        total_time,
+        len(not_cached) / max(total_time, 10.0**-9),
+        args.jobs)
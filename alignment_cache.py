@@ -0,0 +1,65 @@
+import hashlib
+import sqlite3
+
+
+def sequence_hash(seq):
+    return hashlib.sha1(seq).hexdigest()
+
+
+class AlignmentCache(object):
+    """
+    On-disk SQLite store of aligned sequences, keyed by the content of
+    the reference and query sequences together with a string describing
+    the alignment method and its parameters (scoring matrix, gap penalties,
+    algorithm version, &c). Changing any of these gives a different key,
+    so stale alignments are never returned.
+    """
+
+    def __init__(self, path, params):
+        self.path = path
+        self.params = params
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS alignments (
+                ref_hash TEXT,
+                query_hash TEXT,
+                params TEXT,
+                aligned TEXT,
+                PRIMARY KEY (ref_hash, query_hash, params)
+            )
+            """)
+
+    def get(self, ref, seq):
+        """
+        Return previously aligned version of seq against ref, or None
+        """
+        row = self.connection.execute(
+            "SELECT aligned FROM alignments "
+            "WHERE ref_hash = ? AND query_hash = ? AND params = ?",
+            (sequence_hash(ref), sequence_hash(seq), self.params)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return str(row[0])
+
+    def put(self, ref, seq, aligned):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO alignments VALUES (?, ?, ?, ?)",
+            (sequence_hash(ref), sequence_hash(seq), self.params, aligned))
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def summary(self):
+        total = self.hits + self.misses
+        return "Alignment cache %s: %d/%d hits (%0.1f%%)" % (
+            self.path,
+            self.hits,
+            total,
+            100.0 * self.hits / max(total, 1))
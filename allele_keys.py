@@ -0,0 +1,224 @@
+import collections
+import re
+
+import numpy as np
+import pandas as pd
+
+AlleleKey = collections.namedtuple(
+    "AlleleKey", ["species", "locus", "group", "protein"])
+
+# class II loci are followed by a gene number which would otherwise run
+# into the allele digits of compact names such as "DRB10101"
+NUMBERED_LOCI = [
+    "DRB", "DQA", "DQB", "DPA", "DPB", "DMA", "DMB", "DOA", "DOB"
+]
+
+# macaque class I A loci are numbered too (A1, A2, ...), compact names
+# of these have a six digit allele: gene number, group and protein
+NUMBERED_CLASS_I_LOCI = {
+    "Mamu": ["A"],
+    "Mafa": ["A"],
+    "Mane": ["A"],
+}
+
+NUMBERED_CLASS_I_DIGITS = re.compile(r"^([1-9])([0-9]{5}[A-Za-z]*)$")
+
+# at least four allele digits so that serotypes like "HLA-A2" don't match
+COMPACT_ALLELE = re.compile(
+    r"^(%s[0-9]|[A-Za-z]+?)([0-9]{2,3}:?[0-9]{2,3}[A-Za-z]*)$" %
+    "[0-9]|".join(NUMBERED_LOCI))
+
+ALLELE_DIGITS = re.compile(r"^([A-Za-z]*)([0-9:]*)(.*)$")
+
+_parsed_alleles = {}
+
+
+def _split_digits(digits, species):
+    """
+    Split allele digits into (group, protein), accepting "02:01:01" as well
+    as compact forms like "0201". HLA groups always have two digits, for
+    other species a compact name longer than four digits is taken to have
+    a three digit group (e.g. Mamu "00101"). Letters before the digits
+    (e.g. DRB "W38") stay on the group and letters after them (e.g. the
+    "Ps" of pseudogenes) stay on the protein field.
+    """
+    prefix, digits, suffix = ALLELE_DIGITS.match(digits).groups()
+    fields = digits.split(":")
+    if len(fields) > 1:
+        return prefix + fields[0], fields[1] + suffix
+    elif len(digits) <= 3:
+        return prefix + digits, suffix
+    group_width = 2 if species == "HLA" or len(digits) <= 4 else 3
+    return prefix + digits[:group_width], digits[group_width:] + suffix
+
+
+def _clean(name):
+    name = name.strip().replace("_", "*")
+    if name.startswith("H2-"):
+        name = "H-2-" + name[3:]
+    return name
+
+
+def parse_allele(name):
+    """
+    Split an allele name into (species, locus, group, protein), accepting
+    the spellings used by IEDB, IMGT and the files in this repository
+    (e.g. "HLA-A*02:01", "HLA-A0201", "HLA-A*02:01:01:01", "A_02_01").
+    Results are memoized since the same few names recur in every table.
+    Returns None for names without allele digits (e.g. "H-2-Kb") and for
+    heterodimers of two chains (e.g. "HLA-DQA1*01:01/DQB1*06:02").
+
+    >>> parse_allele("Mamu-A1*00101")
+    AlleleKey(species='Mamu', locus='A1', group='001', protein='01')
+    >>> parse_allele("Mamu-A100101")
+    AlleleKey(species='Mamu', locus='A1', group='001', protein='01')
+    """
+    if name in _parsed_alleles:
+        return _parsed_alleles[name]
+    original = name
+    name = _clean(name)
+    if "/" in name:
+        species = rest = None
+    elif name.startswith("H-2-"):
+        species, rest = "H-2", name[4:]
+    elif "-" in name:
+        species, rest = name.split("-", 1)
+    else:
+        species, rest = "HLA", name
+
+    key = None
+    if rest is None:
+        pass
+    elif "*" in rest:
+        locus, digits = rest.split("*", 1)
+        # IMGT style "A*02*01" once '_' has become '*'
+        digits = digits.replace("*", ":")
+        group, protein = _split_digits(digits, species)
+        key = AlleleKey(species, locus, group, protein)
+    else:
+        match = COMPACT_ALLELE.match(rest)
+        if match:
+            locus, digits = match.groups()
+            if locus in NUMBERED_CLASS_I_LOCI.get(species, []):
+                # "A100101" is A1*001:01 rather than A*100:101
+                gene_match = NUMBERED_CLASS_I_DIGITS.match(digits)
+                if gene_match:
+                    locus += gene_match.group(1)
+                    digits = gene_match.group(2)
+            group, protein = _split_digits(digits, species)
+            key = AlleleKey(species, locus, group, protein)
+    _parsed_alleles[original] = key
+    return key
+
+
+def _canonical_heterodimer(name):
+    """
+    Normalize each chain of a class II heterodimer such as
+    "HLA-DQA1*01:01/DQB1*06:02" on its own. Like IEDB, the species is only
+    written before the first chain.
+    """
+    chains = [chain.strip() for chain in name.split("/")]
+    first_key = parse_allele(chains[0])
+    if first_key is None:
+        return name
+    result = [canonical_allele(chains[0])]
+    prefix = first_key.species + "-"
+    for chain in chains[1:]:
+        if "-" not in chain:
+            chain = prefix + chain
+        chain = canonical_allele(chain)
+        if chain.startswith(prefix):
+            chain = chain[len(prefix):]
+        result.append(chain)
+    return "/".join(result)
+
+
+def canonical_allele(name):
+    """
+    Normalized "species-locus*group:protein" form of an allele name, names
+    which can't be parsed are only cleaned up. The chains of heterodimers
+    are normalized separately, e.g. "HLA-DQA10101/DQB10602" becomes
+    "HLA-DQA1*01:01/DQB1*06:02".
+    """
+    if "/" in name:
+        return _canonical_heterodimer(name)
+    key = parse_allele(name)
+    if key is None:
+        return _clean(name)
+    result = "%s-%s*%s" % (key.species, key.locus, key.group)
+    if key.protein:
+        result += ":" + key.protein
+    return result
+
+
+def canonical_alleles(names):
+    """
+    Canonical form of every name in a column, normalizing each distinct
+    name once (missing values stay missing)
+    """
+    codes, uniques = pd.factorize(pd.Series(names))
+    canonical = np.array(
+        [canonical_allele(name) for name in uniques] + [None], dtype=object)
+    return canonical[codes]
+
+
+class AlleleIndex(object):
+    """
+    Integer ids for canonical allele names together with a map from every
+    spelling seen so far to its id, so that joining assay data against
+    sequence tables only has to normalize each distinct name once.
+    Names which aren't in the map yet are looked up by canonical form.
+    """
+
+    def __init__(self, names=[]):
+        self.canonical_names = []
+        self.canonical_ids = {}
+        self.aliases = {}
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self.canonical_names)
+
+    def add(self, name):
+        """
+        Id of an allele name, assigning a new one if its canonical form
+        hasn't been seen
+        """
+        if name in self.aliases:
+            return self.aliases[name]
+        canonical = canonical_allele(name)
+        if canonical not in self.canonical_ids:
+            self.canonical_ids[canonical] = len(self.canonical_names)
+            self.canonical_names.append(canonical)
+        allele_id = self.canonical_ids[canonical]
+        # compact spellings can be ambiguous (e.g. "DPB1*10101"), so also
+        # register the ones tables are known to use for this exact name
+        for alias in [name, name.replace(":", ""), name.replace("*", "")]:
+            self.aliases.setdefault(alias, allele_id)
+        return allele_id
+
+    def get(self, name, default=-1):
+        """
+        Id of an allele name, or `default` if it isn't in the index
+        """
+        if name in self.aliases:
+            return self.aliases[name]
+        allele_id = self.canonical_ids.get(canonical_allele(name), default)
+        if allele_id != default:
+            self.aliases[name] = allele_id
+        return allele_id
+
+    def ids(self, names, add=False):
+        """
+        Array of ids for a column of allele names (-1 for unknown alleles),
+        only looking up each distinct name once
+        """
+        codes, uniques = pd.factorize(pd.Series(names))
+        lookup = self.add if add else self.get
+        unique_ids = np.array([lookup(name) for name in uniques], dtype=int)
+        # missing values get code -1, which picks the appended -1
+        return np.append(unique_ids, -1)[codes]
+
+    def name(self, allele_id):
+        return self.canonical_names[allele_id]
@@ -0,0 +1,298 @@
+import Queue
+import argparse
+import json
+import multiprocessing
+import random
+import resource
+import subprocess
+import time
+import traceback
+from os.path import abspath, dirname, join
+
+from align_seqs import Aligner
+from parsing import parse_fasta_mhc_files
+
+parser = argparse.ArgumentParser(
+    description=
+        'Measure speed, memory use and agreement of the alignment engines '
+        'on fixed subsets of MHC sequences'
+    )
+
+parser.add_argument(
+    "--seqs-dir",
+    default="MHC_Seqs",
+    help="Directory with MHC sequence FASTA files",
+)
+
+parser.add_argument(
+    "--reference-allele",
+    default="HLA-C*08:38",
+    help="Allele to align against",
+)
+
+parser.add_argument(
+    "--engines",
+    default="greedy,dp,nw,banded",
+    help="Comma separated engines to run, agreement is measured against "
+         "the first one"
+)
+
+parser.add_argument(
+    "--max-seqs",
+    type=int,
+    default=50,
+    help="Number of sequences sampled from each subset of MHC_Seqs"
+)
+
+parser.add_argument(
+    "--insertion-sizes",
+    default="1,5,20,50",
+    help="Comma separated insertion lengths for synthetic sequences"
+)
+
+parser.add_argument(
+    "--num-synthetic",
+    type=int,
+    default=20,
+    help="Number of synthetic sequences for each insertion size"
+)
+
+parser.add_argument(
+    "--band-width",
+    type=int,
+    default=10,
+    help="Band width used by the banded engine"
+)
+
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=0,
+)
+
+parser.add_argument(
+    "--output-file",
+    default="alignment_benchmark.json",
+    help="Where to write results as JSON"
+)
+
+# files of MHC_Seqs making up each real-data subset
+SUBSETS = [
+    ("human-class-I", ["A_prot.fasta", "B_prot.fasta", "C_prot.fasta"]),
+    ("nhp-class-I", [
+        "Mamu-A_prot.fasta",
+        "Mamu-B_prot.fasta",
+        "Patr-A_prot.fasta",
+        "Patr-B_prot.fasta",
+        "Gogo-B_prot.fasta",
+    ]),
+    ("non-primate-class-I", [
+        "bola.n.prot.fasta",
+        "sla.1.prot.fasta",
+        "sla.2.prot.fasta",
+        "rt1.a.prot.fasta",
+    ]),
+]
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def sample_subset(seqs_dir, filenames, ref, max_seqs, random_state):
+    """
+    Sample up to max_seqs sequences at least as long as the reference
+    which only contain the 20 standard amino acids
+    """
+    seqs = parse_fasta_mhc_files([join(seqs_dir, f) for f in filenames])
+    usable = [
+        seqs[allele]
+        for allele in sorted(seqs.keys())
+        if len(seqs[allele]) >= len(ref)
+        and all(c in AMINO_ACIDS for c in seqs[allele])
+    ]
+    if len(usable) > max_seqs:
+        usable = random_state.sample(usable, max_seqs)
+    return usable
+
+
+def synthetic_sequences(ref, insertion_size, n, random_state):
+    """
+    Copies of the reference with a few substitutions and one random
+    insertion of the given size. Returns sequences and what each one
+    should look like once aligned.
+    """
+    seqs = []
+    expected = []
+    for _ in xrange(n):
+        residues = list(ref)
+        for _ in xrange(len(ref) // 20):
+            residues[random_state.randint(0, len(ref) - 1)] = \
+                random_state.choice(AMINO_ACIDS)
+        position = random_state.randint(0, len(ref))
+        insertion = [
+            random_state.choice(AMINO_ACIDS) for _ in xrange(insertion_size)
+        ]
+        expected.append("".join(residues))
+        seqs.append("".join(residues[:position] + insertion + residues[position:]))
+    return seqs, expected
+
+
+def make_engine(name, band_width):
+    """
+    Function which aligns a sequence to a reference and returns a string
+    of the reference's length
+    """
+    if name in ("greedy", "dp"):
+        aligner = Aligner(method=name)
+        return aligner.align
+    import pairwise_alignments
+    if name == "nw":
+        return pairwise_alignments.align_to_reference
+    elif name == "banded":
+        matrix = pairwise_alignments.read_ncbi_matrix(pairwise_alignments.MATRIX)
+
+        def align_banded(ref, seq):
+            positions, _ = pairwise_alignments.aligned_positions(
+                ref, seq, band_width=band_width, matrix=matrix)
+            return pairwise_alignments.positions_to_string(seq, positions)
+        return align_banded
+    raise ValueError("Unknown engine: %s" % name)
+
+
+def run_engine(name, band_width, ref, seqs, queue):
+    """
+    Align every sequence with one engine and put the alignments, time taken
+    and memory use on the queue, or the traceback if the engine failed
+    """
+    try:
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        align = make_engine(name, band_width)
+        start_time = time.time()
+        aligned = [align(ref, seq) for seq in seqs]
+        elapsed = time.time() - start_time
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put((None, (aligned, elapsed, start_rss, peak_rss)))
+    except BaseException:
+        queue.put((traceback.format_exc(), None))
+
+
+def measure(name, band_width, ref, seqs):
+    """
+    Run one engine over the sequences in a separate process so that its
+    peak memory use doesn't include other engines
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=run_engine, args=(name, band_width, ref, seqs, queue))
+    process.start()
+    while True:
+        try:
+            error, result = queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            # the process can die without reporting back, e.g. when it's
+            # killed for running out of memory
+            if not process.is_alive() and queue.empty():
+                raise RuntimeError(
+                    "Engine %s exited with code %s without a result" % (
+                        name, process.exitcode))
+    process.join()
+    if error is not None:
+        raise RuntimeError("Engine %s failed:\n%s" % (name, error))
+    return result
+
+
+def agreement(aligned, baseline):
+    """
+    Fraction of sequences and of residues which match the baseline
+    """
+    same_seqs = sum(x == y for (x, y) in zip(aligned, baseline))
+    same_residues = sum(
+        a == b for (x, y) in zip(aligned, baseline) for (a, b) in zip(x, y))
+    total_residues = sum(len(y) for y in baseline)
+    return (
+        same_seqs / float(max(len(baseline), 1)),
+        same_residues / float(max(total_residues, 1)))
+
+
+def git_commit():
+    try:
+        with open("/dev/null", "w") as devnull:
+            return subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=dirname(abspath(__file__)),
+                stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    random_state = random.Random(args.seed)
+    engines = [name for name in args.engines.split(",") if name]
+    assert len(engines) > 0, "No engines given"
+
+    ref_seqs = parse_fasta_mhc_files([join(args.seqs_dir, "C_prot.fasta")])
+    assert args.reference_allele in ref_seqs, \
+        "Reference allele %s not found" % args.reference_allele
+    ref = ref_seqs[args.reference_allele]
+
+    datasets = []
+    for subset_name, filenames in SUBSETS:
+        seqs = sample_subset(
+            args.seqs_dir, filenames, ref, args.max_seqs, random_state)
+        datasets.append((subset_name, seqs, None))
+    for size in [int(x) for x in args.insertion_sizes.split(",") if x]:
+        seqs, expected = synthetic_sequences(
+            ref, size, args.num_synthetic, random_state)
+        datasets.append(("synthetic-insertion-%d" % size, seqs, expected))
+
+    results = []
+    for dataset_name, seqs, expected in datasets:
+        print
+        print "%s: %d sequences" % (dataset_name, len(seqs))
+        baseline = None
+        for name in engines:
+            aligned, elapsed, start_rss, peak_rss = measure(
+                name, args.band_width, ref, seqs)
+            if baseline is None:
+                baseline = aligned
+            seq_agreement, residue_agreement = agreement(aligned, baseline)
+            result = {
+                "dataset": dataset_name,
+                "engine": name,
+                "n_seqs": len(seqs),
+                "seconds": elapsed,
+                "seqs_per_sec": len(seqs) / max(elapsed, 10.0**-9),
+                "peak_rss_kb": peak_rss,
+                "peak_rss_increase_kb": peak_rss - start_rss,
+                "agreement_with": engines[0],
+                "seq_agreement": seq_agreement,
+                "residue_agreement": residue_agreement,
+            }
+            if expected is not None:
+                result["seq_accuracy"], result["residue_accuracy"] = \
+                    agreement(aligned, expected)
+            results.append(result)
+            print "  %-8s %8.2f seqs/sec  peak RSS %7d KB (+%d)  " \
+                "agreement %0.3f (%0.3f residues)%s" % (
+                    name,
+                    result["seqs_per_sec"],
+                    peak_rss,
+                    peak_rss - start_rss,
+                    seq_agreement,
+                    residue_agreement,
+                    "  accuracy %0.3f" % result["residue_accuracy"]
+                    if expected is not None else "")
+
+    with open(args.output_file, "w") as f:
+        json.dump(
+            {
+                "commit": git_commit(),
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "arguments": vars(args),
+                "results": results,
+            },
+            f,
+            indent=2)
+    print
+    print "Wrote %s" % args.output_file
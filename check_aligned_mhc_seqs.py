@@ -1,10 +1,9 @@
 import sys
-from fasta import parse_fasta
+from fasta import read_fasta
 
 filename = sys.argv[1] if len(sys.argv) > 1 else "multispecies_aligned.fasta"
 
-with open(filename,'r') as f:
-    d = parse_fasta(f.read())
+d = read_fasta(filename)
 
 seqs = d.values()
 seqlen = len(seqs[0])
@@ -17,7 +16,7 @@ assert all(len(v)==seqlen for v in seqs), \
             (k, len(v))
             for (k,v) in d.iteritems()
             if len(v) != seqlen
-        ]
+        ])
 
 conserved = set([])
 for i in xrange(seqlen):
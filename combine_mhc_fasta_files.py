@@ -48,17 +48,32 @@ parser.add_argument(
     default = "",
 )
 
+parser.add_argument(
+    "--jobs",
+    type = int,
+    help = "Number of processes to parse FASTA files with",
+    default = 1,
+)
+
+parser.add_argument(
+    "--seqs-cache-dir",
+    type = str,
+    help = "Directory for caching parsed sequences between runs",
+    default = None,
+)
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    exclude_alleles = args.exclude.split(",")
+    exclude_alleles = [allele for allele in args.exclude.split(",") if allele]
     seqs = parse_fasta_mhc_dirs(
-        [args.dir],
+        [args.input_dir],
         min_length = args.min_length,
-        exclude_alleles=exclude_alleles)
+        exclude_allele_substrings = exclude_alleles,
+        processes = args.jobs,
+        cache_dir = args.seqs_cache_dir)
 
-    assert len(seqs) > 0, "No sequences found in directory %s" % args.dir
+    assert len(seqs) > 0, "No sequences found in directory %s" % args.input_dir
     if args.output_file:
         with open(args.output_file, 'w') as f:
             for allele in sorted(seqs.keys()):
@@ -1,5 +1,7 @@
 import numpy as np
 
+from allele_keys import canonical_alleles
+
 def extract_columns(df_peptides):
     ic50 = np.array(df_peptides["IC50_Median"])
     has_ic50 = np.array(df_peptides["IC50_Count"] > 0)
@@ -47,7 +49,6 @@ def extract_columns(df_peptides):
     print "# binding category == 1", (category == 1).sum()
     print "# binding category == 0", (category == 0).sum()
     print "# binding category == -1", (category == -1).sum()
-    # reformat HLA allales 'HLA-A*03:01' into 'HLA-A03:01'
     alleles = df_peptides['MHC Allele']
     epitopes = df_peptides['Epitope']
     return alleles, epitopes, category, ic50, ic50_mask 
@@ -58,8 +59,7 @@ def filter_dataframe(
         length = None, 
         mhc_class = "I"):
 
-    df_peptides['MHC Allele'] = \
-        df_peptides['MHC Allele'].str.replace('*', '').str.strip()
+    df_peptides['MHC Allele'] = canonical_alleles(df_peptides['MHC Allele'])
     
     if human:
         human_mask = df_peptides["MHC Allele"].str.startswith("HLA")
@@ -1,10 +1,14 @@
 from collections import OrderedDict
+import csv
+import hashlib
+import os
+import time
+import zipfile
 
 import pandas as pd
 import numpy as np
-from amino_acids import AMINO_ACID_LETTERS, AMINO_ACID_PAIRS, AMINO_ACID_PAIR_POSITIONS
 
-from os.path import exists,  join
+from os.path import basename, exists,  join
 import subprocess
 import pandas as pd
 import logging
@@ -13,21 +17,111 @@ import logging
 IEDB_FILENAME = "mhc_ligand_full.csv"
 IEDB_URL = "http://www.iedb.org/doc/mhc_ligand_full.zip"
 
-def download_iedb_database(filename, url):
-    if not exists(filename):
-        subprocess.check_call(["wget", url])
-        zipped_name = url.split("/")[-1]
-        subprocess.check_call(["unzip", zipped_name])
-    return pd.read_csv(filename, error_bad_lines=False, header=[0,1])
-
-
-def load_iedb(filename, url, only_human = False):
-
-    df = download_iedb_database(filename, url)
-
-    logging.info("IEDB contains %d entries", len(df))
+# rows of the IEDB export parsed at a time
+IEDB_CHUNK_SIZE = 100000
+
+# (group, field) pairs of the two-row IEDB header which load_iedb uses,
+# along with the dtype to parse each of them as
+IEDB_COLUMNS = [
+    (("Epitope", "Description"), str),
+    (("Epitope", "Object Type"), str),
+    (("MHC", "Allele Name"), str),
+    (("MHC", "MHC allele class"), str),
+    (("Assay", "Qualitative Measure"), str),
+    (("Assay", "Quantitative measurement"), float),
+    (("Assay", "Units"), str),
+    (("Assay", "Method/Technique"), str),
+    (("Reference", "Title"), str),
+]
 
-    epitopes = df['Epitope']['Description'].str.upper().str.strip()
+def download_iedb_database(url):
+    """
+    Local path of the zipped IEDB export at `url`, which is downloaded
+    unless it's already a local path or file:// URL. The archive isn't
+    unpacked since the CSV is read straight out of it.
+    """
+    if url.startswith("file://"):
+        return url[len("file://"):]
+    elif exists(url):
+        return url
+    zipped_name = url.split("/")[-1]
+    if not exists(zipped_name):
+        subprocess.check_call(["wget", url])
+    return zipped_name
+
+
+def iedb_source_path(filename, url):
+    """
+    Local file the IEDB export is read from: `filename` if it exists,
+    otherwise the zip archive at `url`
+    """
+    if exists(filename):
+        return filename
+    return download_iedb_database(url)
+
+
+def open_iedb_export(filename, url):
+    """
+    Open the IEDB CSV export at `filename` if it exists (either as a CSV or
+    a zip archive), otherwise stream the CSV member of the zip archive at
+    `url`, decompressing it as it's read
+    """
+    zip_path = iedb_source_path(filename, url)
+    if not zipfile.is_zipfile(zip_path):
+        return open(zip_path)
+    archive = zipfile.ZipFile(zip_path)
+    names = archive.namelist()
+    if basename(filename) in names:
+        member = basename(filename)
+    else:
+        csv_names = [name for name in names if name.endswith(".csv")]
+        assert len(csv_names) == 1, \
+            "Expected one CSV file in %s, found %s" % (zip_path, names)
+        member = csv_names[0]
+    logging.info("Reading %s from %s", member, zip_path)
+    return archive.open(member)
+
+
+def read_iedb_chunks(f, chunksize=IEDB_CHUNK_SIZE):
+    """
+    Parse only the columns in IEDB_COLUMNS from an open IEDB export,
+    yielding DataFrames of up to `chunksize` rows whose columns are named
+    by the field half of each (group, field) header pair
+    """
+    # read the two header lines with readline so that the rest of the
+    # file is left for the CSV parser
+    groups = next(csv.reader([f.readline()]))
+    fields = next(csv.reader([f.readline()]))
+    # the group row may only name the first column of each group
+    for i in xrange(1, len(groups)):
+        if not groups[i]:
+            groups[i] = groups[i - 1]
+    header = list(zip(groups, fields))
+    usecols = []
+    dtypes = {}
+    names = {}
+    for (key, dtype) in IEDB_COLUMNS:
+        assert key in header, "Column %s missing from IEDB export" % (key,)
+        i = header.index(key)
+        usecols.append(i)
+        dtypes[i] = dtype
+        names[i] = key[1]
+    for df in pd.read_csv(
+            f,
+            header=None,
+            usecols=usecols,
+            dtype=dtypes,
+            chunksize=chunksize,
+            error_bad_lines=False):
+        yield df.rename(columns=names)
+
+
+def clean_iedb_chunk(df, only_human=False):
+    """
+    Keep the valid linear peptide assays of one chunk of the IEDB export,
+    returns the cleaned rows and the number of invalid epitope strings
+    """
+    epitopes = df['Description'].str.upper().str.strip()
     # make sure there is an epitope string and it's at least a 5mer
     mask = ~epitopes.isnull()
     mask &= epitopes.str.len() >= 5
@@ -37,12 +131,9 @@ def load_iedb(filename, url, only_human = False):
     # drop epitopes with special characters
     mask &= ~epitopes.str.contains('\(|\)|\+', na=False)
 
-    logging.info(
-        "Dropped %d invalid epitope strings",
-        (len(mask) - mask.sum())
-    )
+    n_invalid_epitopes = len(mask) - mask.sum()
 
-    alleles = df['MHC']['Allele Name']
+    alleles = df['Allele Name']
 
     # drop missing allele names
     mask &= ~alleles.isnull()
@@ -56,32 +147,157 @@ def load_iedb(filename, url, only_human = False):
         # only count human HLA types
         mask &= alleles.str.startswith("HLA-")
 
-    epitope_type = df['Epitope']['Object Type']
+    epitope_type = df['Object Type']
 
     mask &=  epitope_type == 'Linear peptide'
 
     df = df[mask]
     epitopes = epitopes[mask]
 
-    mhc_class =  df['MHC']['MHC allele class']
-    categories = df['Assay'][['Qualitative Measure']]
-    binding_scores = df['Assay']['Quantitative measurement']
-    assay_units = df['Assay']['Units'].str.replace("\[nM\]", "nM")
-    assay_method = df['Assay']['Method/Technique'].str.lower()
-    paper = df['Reference']['Title']
-
     df_clean = pd.DataFrame({})
     df_clean['Epitope'] = epitopes
-    df_clean['MHC Allele'] = alleles
-    df_clean['MHC Class'] = mhc_class
-    df_clean['Assay Method'] = assay_method
-    df_clean['Assay Units'] = assay_units
-    df_clean['Assay Value'] =  binding_scores
-    df_clean['Binder'] = categories
-    df_clean['Paper'] = paper
+    df_clean['MHC Allele'] = df['Allele Name']
+    df_clean['MHC Class'] = df['MHC allele class']
+    df_clean['Assay Method'] = df['Method/Technique'].str.lower()
+    df_clean['Assay Units'] = df['Units'].str.replace("\[nM\]", "nM")
+    df_clean['Assay Value'] =  df['Quantitative measurement']
+    df_clean['Binder'] = df['Qualitative Measure']
+    df_clean['Paper'] = df['Title']
+    return df_clean, n_invalid_epitopes
+
+
+# bump when the cleaning rules change so that old caches are ignored
+IEDB_CACHE_VERSION = 1
+
+# low cardinality columns of the cleaned table, kept as pandas categoricals
+IEDB_CATEGORICAL_COLUMNS = [
+    'MHC Allele',
+    'MHC Class',
+    'Assay Method',
+    'Assay Units',
+    'Binder',
+]
+
+def file_digest(path, block_size=2 ** 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def save_iedb_cache(df, path, source_key):
+    """
+    Write the cleaned IEDB table to an HDF5 file with one group per
+    column. String columns are stored as integer codes into a table of
+    distinct values (missing values get code -1), numeric columns as is.
+    """
+    import h5py
+    with h5py.File(path, 'w') as f:
+        for (k, v) in source_key.items():
+            f.attrs[k] = v
+        f.attrs['columns'] = [str(c) for c in df.columns]
+        f['index'] = np.asarray(df.index)
+        for column in df.columns:
+            group = f.create_group(column)
+            values = df[column]
+            if values.dtype == object or hasattr(values, 'cat'):
+                categorical = pd.Categorical(values)
+                group['codes'] = categorical.codes.astype(np.int32)
+                group.create_dataset(
+                    'categories',
+                    data=[str(c) for c in categorical.categories],
+                    dtype=h5py.special_dtype(vlen=str))
+            else:
+                group['values'] = np.asarray(values)
+
+
+def load_iedb_cache(path, source_key, columns=None):
+    """
+    Load the cleaned IEDB table written by save_iedb_cache, or only some
+    of its columns. Returns None if the cache is missing or was made from
+    a different source file or with different options.
+    """
+    import h5py
+    if not exists(path):
+        return None
+    with h5py.File(path, 'r') as f:
+        for (k, v) in source_key.items():
+            if k not in f.attrs or f.attrs[k] != v:
+                logging.info("IEDB cache %s is out of date", path)
+                return None
+        if columns is None:
+            columns = list(f.attrs['columns'])
+        df = pd.DataFrame(index=f['index'][:])
+        for column in columns:
+            group = f[column]
+            if 'codes' in group:
+                # h5py gives back unicode, keep the str of the parsed table
+                categories = [
+                    c.encode('utf-8') if isinstance(c, unicode) else c
+                    for c in group['categories'][:]
+                ]
+                values = pd.Categorical.from_codes(
+                    group['codes'][:], categories)
+                if column not in IEDB_CATEGORICAL_COLUMNS:
+                    values = np.asarray(values)
+            else:
+                values = group['values'][:]
+            df[column] = values
+    logging.info("Loaded %d IEDB entries from %s", len(df), path)
+    return df
+
+
+def load_iedb(
+        filename,
+        url,
+        only_human = False,
+        chunksize = IEDB_CHUNK_SIZE,
+        cache_file = None,
+        columns = None):
+    """
+    Cleaned table of IEDB assays. If `cache_file` is given, the table is
+    stored there keyed by the content of the source file and later calls
+    load it from there (optionally only the given `columns`) instead of
+    parsing the export again.
+    """
+    if cache_file:
+        source_path = iedb_source_path(filename, url)
+        source_key = {
+            'version': IEDB_CACHE_VERSION,
+            'source_sha1': file_digest(source_path),
+            'source_size': os.path.getsize(source_path),
+            'only_human': only_human,
+        }
+        df_clean = load_iedb_cache(cache_file, source_key, columns=columns)
+        if df_clean is not None:
+            return df_clean
+
+    # filter each chunk as it's read so that only the surviving rows
+    # are ever held in memory together
+    n_entries = 0
+    n_invalid_epitopes = 0
+    chunks = []
+    with open_iedb_export(filename, url) as f:
+        for df in read_iedb_chunks(f, chunksize=chunksize):
+            n_entries += len(df)
+            df_clean, n_invalid = clean_iedb_chunk(df, only_human=only_human)
+            n_invalid_epitopes += n_invalid
+            chunks.append(df_clean)
+
+    logging.info("IEDB contains %d entries", n_entries)
+    logging.info("Dropped %d invalid epitope strings", n_invalid_epitopes)
+
+    df_clean = pd.concat(chunks)
+    for column in IEDB_CATEGORICAL_COLUMNS:
+        df_clean[column] = df_clean[column].astype('category')
 
     logging.info("Final DataFrame with %d entries", len(df_clean))
 
+    if cache_file:
+        save_iedb_cache(df_clean, cache_file, source_key)
+    if columns is not None:
+        df_clean = df_clean[columns]
     return df_clean
 
 # looked at intersections of IEDB results, found
@@ -95,6 +311,15 @@ EQUIV_ASSAY_METHODS = [
     # ("cell bound mhc - radioactivity", "IC50")
 ]
 
+def first_allele_classes(df_peptides):
+    """
+    MHC class of each allele's first row, indexed by allele
+    """
+    first_rows = df_peptides.drop_duplicates("MHC Allele")
+    return pd.Series(
+        np.asarray(first_rows["MHC Class"]),
+        index=np.asarray(first_rows["MHC Allele"]))
+
 def group_by_peptide_and_allele(
         df_peptides,
         max_ic50 = 10**7,
@@ -120,8 +345,6 @@ def group_by_peptide_and_allele(
 
     df_peptides['Assay Mask'] = assay_mask
 
-    records = []
-
     positive_binding_categories = [
         "Positive",
         "Positive-Low",
@@ -129,32 +352,260 @@ def group_by_peptide_and_allele(
         "Positive-High"
     ]
     print "Generating grouped peptide data"
-    for allele, allele_group in df_peptides.groupby(["MHC Allele"]):
-        mhc_class = allele_group['MHC Class'].irow(0)
-        print "  ", allele, len(allele_group)
-        for epitope, group in allele_group.groupby("Epitope"):
-            record = OrderedDict()
-            record["MHC Allele"] = allele
-            record["MHC Class"] = mhc_class
-            record["Epitope"] = epitope
-            record["Count"] = len(group)
-
-            for label in positive_binding_categories:
-                record[label] = (group["Binder"] == label).sum()
-            record["Negative"] = (group["Binder"] == "Negative").sum()
-            record['Positive-All'] = \
-                sum(record[l] for l in positive_binding_categories)
-            ic50 = group['Assay Value']
-            mask = group['Assay Mask']
-            ic50 = ic50[mask]
-            record['IC50_Count'] = len(ic50)
-            record['IC50_Min'] = ic50.min()
-            record['IC50_Max'] = ic50.max()
-            record['IC50_Median'] = ic50.median()
-            record['IC50_Std'] = ic50.std()
-            records.append(record)
-    return pd.DataFrame.from_records(records)
-
+    start_time = time.time()
+
+    allele_classes = first_allele_classes(df_peptides)
+
+    for allele, count in df_peptides["MHC Allele"].value_counts(
+            sort=False).sort_index().iteritems():
+        if count > 0:
+            print "  ", allele, count
+
+    # rows without an allele or epitope don't belong to any group
+    df = df_peptides[
+        ~df_peptides["MHC Allele"].isnull() & ~df_peptides["Epitope"].isnull()]
+
+    # number every (allele, epitope) group in sorted order and accumulate
+    # all per-group counts and statistics over those numbers at once
+    allele_codes, _ = pd.factorize(np.asarray(df["MHC Allele"]), sort=True)
+    epitope_codes, epitopes = pd.factorize(
+        np.asarray(df["Epitope"]), sort=True)
+    _, first_rows, group_ids = np.unique(
+        allele_codes.astype(np.int64) * len(epitopes) + epitope_codes,
+        return_index=True,
+        return_inverse=True)
+    n_groups = len(first_rows)
+    group_alleles = np.asarray(df["MHC Allele"])[first_rows]
+
+    def group_sums(weights=None):
+        return np.bincount(group_ids, weights=weights, minlength=n_groups)
+
+    df_grouped = pd.DataFrame(OrderedDict([
+        ("MHC Allele", group_alleles),
+        ("MHC Class", np.asarray(allele_classes[group_alleles])),
+        ("Epitope", np.asarray(df["Epitope"])[first_rows]),
+        ("Count", group_sums()),
+    ]))
+    binders = np.asarray(df["Binder"])
+    for label in positive_binding_categories + ["Negative"]:
+        df_grouped[label] = group_sums(binders == label).astype(np.int64)
+    df_grouped['Positive-All'] = \
+        df_grouped[positive_binding_categories].sum(axis=1)
+
+    mask = np.asarray(df['Assay Mask'], dtype=bool)
+    ic50 = np.asarray(df['Assay Value'], dtype=np.float64)[mask]
+    ic50_ids = group_ids[mask]
+    ic50_groups = pd.Series(ic50).groupby(ic50_ids)
+    ic50_count = np.bincount(ic50_ids, minlength=n_groups)
+    df_grouped['IC50_Count'] = ic50_count
+    for name, values in [
+            ('IC50_Min', ic50_groups.min()),
+            ('IC50_Max', ic50_groups.max()),
+            ('IC50_Median', ic50_groups.median())]:
+        column = np.full(n_groups, np.nan)
+        column[values.index] = values.values
+        df_grouped[name] = column
+
+    # standard deviation with the same two-pass arithmetic as Series.std,
+    # numpy sums eight or more values pairwise rather than in order so
+    # those (few) groups are left to Series.std itself
+    ic50_sum = np.bincount(ic50_ids, weights=ic50, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = ic50_sum / ic50_count
+        squares = np.bincount(
+            ic50_ids,
+            weights=(mean[ic50_ids] - ic50) ** 2,
+            minlength=n_groups)
+        std = np.sqrt(squares / (ic50_count - 1.0))
+    std[ic50_count <= 1] = np.nan
+    order = np.argsort(ic50_ids, kind='mergesort')
+    ends = np.cumsum(ic50_count)
+    for i in np.where(ic50_count >= 8)[0]:
+        group_values = ic50[order[ends[i] - ic50_count[i]:ends[i]]]
+        std[i] = pd.Series(group_values).std()
+    df_grouped['IC50_Std'] = std
+
+    print "Grouped %d entries into %d allele/peptide pairs in %0.2fs" % (
+        len(df), n_groups, time.time() - start_time)
+    return df_grouped
+
+def row_keys(df, columns):
+    """
+    64-bit hash of the values in the given columns of each row, which is
+    the same for categorical and plain object columns holding equal values
+    """
+    return pd.util.hash_pandas_object(df[columns], index=False).values
+
+def assay_row_keys(df_iedb):
+    """
+    Key of every assay in a cleaned IEDB table, stays the same for an assay
+    between releases since the export has no stable assay ids
+    """
+    return row_keys(df_iedb, list(df_iedb.columns))
+
+def allele_epitope_keys(df):
+    return row_keys(df, ["MHC Allele", "Epitope"])
+
+def keys_in(keys, test_keys):
+    """
+    Like np.in1d, but with a hash table instead of sorting both arrays
+    """
+    return pd.Series(keys).isin(test_keys).values
+
+def merge_sorted_groups(df_a, df_b):
+    """
+    Combine two grouped tables which are each sorted by allele and epitope
+    into one sorted table, without sorting all of it again. Expects the
+    second table to be the smaller one and no pair to be in both.
+    """
+    alleles = np.asarray(df_a["MHC Allele"], dtype=object)
+    epitopes = np.asarray(df_a["Epitope"], dtype=object)
+    starts = np.searchsorted(
+        alleles, np.asarray(df_b["MHC Allele"], dtype=object), side='left')
+    ends = np.searchsorted(
+        alleles, np.asarray(df_b["MHC Allele"], dtype=object), side='right')
+    positions = np.array([
+        start + np.searchsorted(epitopes[start:end], epitope)
+        for (start, end, epitope) in zip(starts, ends, df_b["Epitope"])
+    ], dtype=int)
+    # rows of df_b go before the df_a row they'd be inserted at, shifted
+    # down by the df_b rows ahead of them
+    n = len(df_a) + len(df_b)
+    b_slots = positions + np.arange(len(df_b))
+    order = np.empty(n, dtype=int)
+    in_b = np.zeros(n, dtype=bool)
+    in_b[b_slots] = True
+    order[~in_b] = np.arange(len(df_a))
+    order[b_slots] = len(df_a) + np.arange(len(df_b))
+    df = pd.concat([df_a, df_b]).iloc[order]
+    return df.reset_index(drop=True)
+
+def regroup_changed_assays(
+        df_iedb,
+        assay_keys,
+        assay_pairs,
+        previous_assay_keys,
+        previous_assay_pairs,
+        df_previous_grouped,
+        previous_grouped_pairs,
+        **kwargs):
+    """
+    Update the grouped table of a previous run for a new cleaned IEDB table
+    by only regrouping the (allele, epitope) pairs which gained or lost
+    assays, comparing the assay keys and (allele, epitope) keys of every
+    row of both tables. Extra keyword arguments go to
+    group_by_peptide_and_allele. Unchanged groups are copied, so their
+    results only match a full regrouping if the export kept their rows in
+    the same order.
+    """
+    added = ~keys_in(assay_keys, previous_assay_keys)
+    removed = ~keys_in(previous_assay_keys, assay_keys)
+    n_added = added.sum()
+    n_removed = removed.sum()
+    # identical assays can repeat, so for the few keys in both tables which
+    # occur more than once also compare how many times they occur
+    repeated = pd.unique(np.concatenate([
+        assay_keys[
+            ~added & pd.Series(assay_keys).duplicated(keep=False).values],
+        previous_assay_keys[
+            ~removed &
+            pd.Series(previous_assay_keys).duplicated(keep=False).values]]))
+    count_changes = pd.Series(
+        assay_keys[keys_in(assay_keys, repeated)]).value_counts().sub(
+            pd.Series(previous_assay_keys[
+                keys_in(previous_assay_keys, repeated)]).value_counts(),
+            fill_value=0)
+    recounted = count_changes.index[count_changes != 0].values
+    if len(recounted) > 0:
+        added |= keys_in(assay_keys, recounted)
+        removed |= keys_in(previous_assay_keys, recounted)
+        n_added += count_changes[count_changes > 0].sum()
+        n_removed -= count_changes[count_changes < 0].sum()
+
+    affected = pd.unique(np.concatenate([
+        assay_pairs[added], previous_assay_pairs[removed]]))
+
+    unchanged = df_previous_grouped[
+        ~keys_in(previous_grouped_pairs, affected)]
+    df_changed = df_iedb[keys_in(assay_pairs, affected)].copy()
+    regrouped = group_by_peptide_and_allele(df_changed, **kwargs)
+
+    df_grouped = merge_sorted_groups(unchanged, regrouped)
+    # an allele's first row may have changed along with its class
+    df_grouped["MHC Class"] = np.asarray(
+        first_allele_classes(df_iedb)[np.asarray(df_grouped["MHC Allele"])])
+
+    updated = keys_in(
+        previous_grouped_pairs, allele_epitope_keys(regrouped)).sum()
+    print "%d assays added, %d removed" % (n_added, n_removed)
+    print "Regrouped %d allele/peptide pairs: %d new, %d updated, %d dropped" \
+        " (%d unchanged)" % (
+            len(affected),
+            len(regrouped) - updated,
+            updated,
+            len(df_previous_grouped) - len(unchanged) - updated,
+            len(unchanged))
+    return df_grouped
+
+# bump when grouping changes so that saved state is ignored
+INCREMENTAL_STATE_VERSION = 1
+
+def incremental_state_path(grouped_output):
+    return grouped_output + ".state.hdf"
+
+def save_incremental_state(path, assay_keys, assay_pairs, df_grouped):
+    """
+    Keep what the next --incremental run needs next to the grouped output:
+    the grouped table itself and the assay and (allele, epitope) keys of
+    the IEDB table it came from. String columns are stored as fixed width
+    byte strings (missing values as empty strings), which unlike the
+    categorical layout of the IEDB cache needs no pass to find the
+    distinct values of the (mostly distinct) epitopes.
+    """
+    import h5py
+    # write to a temporary name first so that an interrupted run doesn't
+    # leave a state which doesn't match the grouped output behind
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with h5py.File(tmp_path, 'w') as f:
+        f.attrs['version'] = INCREMENTAL_STATE_VERSION
+        f.attrs['columns'] = [str(c) for c in df_grouped.columns]
+        group = f.create_group('grouped')
+        for column in df_grouped.columns:
+            values = np.asarray(df_grouped[column])
+            if values.dtype == object:
+                values = np.asarray(
+                    pd.Series(values).fillna('').values, dtype=str)
+            group[column] = values
+        f['assay_keys'] = assay_keys
+        f['assay_pairs'] = assay_pairs
+        f['grouped_pairs'] = allele_epitope_keys(df_grouped)
+    os.rename(tmp_path, path)
+
+def load_incremental_state(path):
+    """
+    Assay keys, assay (allele, epitope) keys, grouped table and grouped
+    (allele, epitope) keys saved by save_incremental_state, or None if
+    there's no usable state
+    """
+    import h5py
+    if not exists(path):
+        return None
+    with h5py.File(path, 'r') as f:
+        if f.attrs.get('version') != INCREMENTAL_STATE_VERSION:
+            logging.info("Incremental state %s is out of date", path)
+            return None
+        columns = OrderedDict()
+        for column in f.attrs['columns']:
+            values = f['grouped'][column][:]
+            if values.dtype.kind == 'S':
+                values = values.astype(object)
+                values[values == ''] = None
+            columns[column] = values
+        return (
+            f['assay_keys'][:],
+            f['assay_pairs'][:],
+            pd.DataFrame(columns),
+            f['grouped_pairs'][:])
 
 
 if __name__ == '__main__':
@@ -166,22 +617,43 @@ if __name__ == '__main__':
     parser.add_argument(
         "--iedb-filename",
         default = IEDB_FILENAME,
+        help = "IEDB export as a CSV or zip file, read from --iedb-url "
+               "when it doesn't exist",
     )
     parser.add_argument(
         "--iedb-url",
         default = IEDB_URL,
+        help = "URL, local path or file:// URL of the zipped IEDB export",
     )
     parser.add_argument(
         "--iedb-output",
         default='mhc.csv')
 
+    parser.add_argument(
+        "--iedb-cache-file",
+        default = None,
+        help = "HDF5 file to keep the cleaned IEDB table in between runs",
+    )
+
     parser.add_argument(
         "--grouped-output",
         default='mhc_grouped.csv')
 
+    parser.add_argument(
+        "--incremental",
+        default = False,
+        action = "store_true",
+        help = "Only regroup the allele/peptide pairs whose assays changed "
+               "since the last --incremental run, using the keys it saved "
+               "next to --grouped-output",
+    )
+
     args = parser.parse_args()
 
-    df_iedb = load_iedb(args.iedb_filename, args.iedb_url)
+    df_iedb = load_iedb(
+        args.iedb_filename,
+        args.iedb_url,
+        cache_file = args.iedb_cache_file)
 
     logging.info("# assay results = %d", len(df_iedb))
 
@@ -191,11 +663,29 @@ if __name__ == '__main__':
     if args.iedb_output:
         df_iedb.to_csv(args.iedb_output, index=False)
 
-    df_peptides = group_by_peptide_and_allele(df_iedb)
+    state_path = None
+    if args.incremental:
+        assert args.grouped_output, "--incremental needs --grouped-output"
+        state_path = incremental_state_path(args.grouped_output)
+        # keyed before grouping, which adds columns to the table
+        assay_keys = assay_row_keys(df_iedb)
+        assay_pairs = allele_epitope_keys(df_iedb)
+        previous_state = load_incremental_state(state_path)
+        if previous_state is None:
+            print "No previous state in %s, regrouping everything" % (
+                state_path,)
+
+    if state_path and previous_state is not None:
+        df_peptides = regroup_changed_assays(
+            df_iedb, assay_keys, assay_pairs, *previous_state)
+    else:
+        df_peptides = group_by_peptide_and_allele(df_iedb)
 
     print df_peptides
     print "Generated %d allele/peptide pairs" % len(df_peptides)
 
     if args.grouped_output:
         df_peptides.to_csv(args.grouped_output, index=False)
-
+    if state_path:
+        save_incremental_state(
+            state_path, assay_keys, assay_pairs, df_peptides)
@@ -1,8 +1,8 @@
 import argparse
-import collections
 
-from parsing import parse_fasta_mhc_files
-from seq_helpers import positional_letter_counts
+import numpy as np
+
+from parsing import parse_fasta_mhc_store
 
 
 parser = argparse.ArgumentParser(
@@ -30,17 +30,23 @@ parser.add_argument(
          "to be considered 'informative'"
 )
 
+parser.add_argument(
+    "--seqs-cache-dir",
+    default=None,
+    help="Directory for caching parsed sequences between runs"
+)
+
 if __name__ == "__main__":
     args = parser.parse_args()
-    seqs_dict = parse_fasta_mhc_files([args.input_file])
-    counts = positional_letter_counts(seqs_dict.values())
-    max_count = int( (1.0 - args.min_different_fraction) * len(seqs_dict))
+    store = parse_fasta_mhc_store(
+        [args.input_file], cache_dir=args.seqs_cache_dir)
+    counts = store.column_counts()
+    max_count = int( (1.0 - args.min_different_fraction) * len(store))
     print "Max same for position to be kept: %d" % max_count
-    keep = [i for i,c in enumerate(counts) if c.most_common()[0][1] < max_count]
+    keep = np.where(counts.max(axis=1) < max_count)[0]
     print "Keeping %d/%d positions" % (len(keep), len(counts))
-    print "--", keep
+    print "--", list(keep)
+    subsets = store.matrix()[:, keep]
     with open(args.output_file, 'w') as f:
-        for allele in sorted(seqs_dict.keys()):
-            seq = seqs_dict[allele]
-            subset = "".join([seq[i] for i in keep])
-            f.write(">%s\n%s\n" % (allele, subset))
\ No newline at end of file
+        for allele, subset in zip(store.names, subsets):
+            f.write(">%s\n%s\n" % (allele, subset.tostring()))
\ No newline at end of file
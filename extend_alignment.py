@@ -0,0 +1,177 @@
+import argparse
+import shutil
+
+from Bio.SeqIO.FastaIO import FastaIterator
+import numpy as np
+
+from align_seqs import Aligner
+from parsing import parse_fasta_mhc_files
+from seq_helpers import positional_letter_counts, group_by_sequence
+
+parser = argparse.ArgumentParser(
+    description=
+        'Add new sequences to an existing multiple alignment by aligning '
+        'them against its profile, without changing the existing rows'
+    )
+
+parser.add_argument(
+    "--alignment-file",
+    required=True,
+    help="FASTA file of aligned sequences (all the same length)",
+)
+
+parser.add_argument(
+    "--new-seqs",
+    required=True,
+    help="Comma separated FASTA files with sequences to add",
+)
+
+parser.add_argument(
+    "--output-file",
+    default=None,
+    help="Output FASTA file (default: append to --alignment-file)",
+)
+
+parser.add_argument(
+    "--coeff-matrix",
+    type=str,
+    default="blosum50",
+    help="Substitution matrix used to score residues against the profile"
+)
+
+parser.add_argument(
+    "--gap-penalty",
+    type=float,
+    default=-8.0,
+    help="Score for leaving an alignment column empty, scaled by the "
+         "fraction of existing rows which have a residue in that column"
+)
+
+parser.add_argument(
+    "--insertion-penalty",
+    type=float,
+    default=-8.0,
+    help="Score for dropping a residue which doesn't fit any column"
+)
+
+
+def alignment_profile(aligned_seqs, aligner):
+    """
+    Expected substitution score of each residue against each column of an
+    alignment, and the fraction of rows with a gap in each column
+    """
+    counters = positional_letter_counts(aligned_seqs)
+    n_letters = len(aligner.letters)
+    frequencies = np.zeros((len(counters), n_letters))
+    gap_fractions = np.zeros(len(counters))
+    for i, counter in enumerate(counters):
+        gap_fractions[i] = counter["-"] / float(len(aligned_seqs))
+        for letter, count in counter.iteritems():
+            if letter in aligner.letter_indices:
+                frequencies[i, aligner.letter_indices[letter]] = count
+        total = frequencies[i].sum()
+        if total > 0:
+            frequencies[i] /= total
+    return frequencies.dot(aligner.coeff_matrix.T), gap_fractions
+
+
+def profile_positions(
+        profile_scores, gap_scores, seq_idx, insertion_penalty):
+    """
+    Global alignment of a sequence (array of residue numbers) against the
+    columns of a profile, where residues which don't fit a column are
+    dropped. Returns the position of the sequence (or -1) placed in each
+    column.
+    """
+    n = len(profile_scores)
+    m = len(seq_idx)
+    cols = np.arange(m + 1)
+    H = np.empty((n + 1, m + 1))
+    H[0] = cols * insertion_penalty
+    for i in xrange(1, n + 1):
+        diagonal = np.full(m + 1, -np.inf)
+        diagonal[1:] = H[i - 1, :-1] + profile_scores[i - 1, seq_idx]
+        best = np.maximum(diagonal, H[i - 1] + gap_scores[i - 1])
+        # dropping residues moves along the row, the best starting cell
+        # for every column comes from a running maximum
+        H[i] = np.maximum.accumulate(best - cols * insertion_penalty)
+        H[i] += cols * insertion_penalty
+
+    # profile scores aren't integers, so compare with a tolerance for
+    # the rounding error of the running maximum above
+    positions = np.full(n, -1, dtype=int)
+    i, j = n, m
+    while i > 0:
+        if j > 0 and np.isclose(
+                H[i, j],
+                H[i - 1, j - 1] + profile_scores[i - 1, seq_idx[j - 1]]):
+            positions[i - 1] = j - 1
+            i -= 1
+            j -= 1
+        elif np.isclose(H[i, j], H[i - 1, j] + gap_scores[i - 1]):
+            i -= 1
+        else:
+            j -= 1
+    return positions
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    with open(args.alignment_file) as f:
+        existing = [
+            (record.id, str(record.seq)) for record in FastaIterator(f)]
+    existing_names = set(name for (name, _) in existing)
+    aligned_seqs = [seq for (_, seq) in existing]
+    n_cols = len(aligned_seqs[0])
+    assert all(len(seq) == n_cols for seq in aligned_seqs), \
+        "Sequences in %s aren't all the same length" % args.alignment_file
+    print "Existing alignment: %d sequences, %d columns" % (
+        len(aligned_seqs), n_cols)
+
+    aligner = Aligner(args.coeff_matrix)
+    profile_scores, gap_fractions = alignment_profile(aligned_seqs, aligner)
+    gap_scores = args.gap_penalty * (1.0 - gap_fractions)
+
+    new_seqs = parse_fasta_mhc_files(
+        [path for path in args.new_seqs.split(",") if path])
+    to_add = []
+    for allele in sorted(new_seqs.keys()):
+        seq = new_seqs[allele]
+        if allele in existing_names:
+            continue
+        elif any(c not in aligner.letter_indices for c in seq):
+            print "Skipping %s, unknown residues" % allele
+        else:
+            to_add.append((allele, seq))
+    distinct_seqs, seq_alleles = group_by_sequence(to_add)
+    print "Adding %d sequences (%d distinct)" % (
+        len(to_add), len(distinct_seqs))
+
+    if args.output_file:
+        shutil.copyfile(args.alignment_file, args.output_file)
+        output_path = args.output_file
+    else:
+        output_path = args.alignment_file
+
+    with open(output_path, "r") as f:
+        f.seek(0, 2)
+        needs_newline = f.tell() > 0
+        if needs_newline:
+            f.seek(-1, 2)
+            needs_newline = f.read(1) != "\n"
+
+    with open(output_path, "a") as f:
+        if needs_newline:
+            f.write("\n")
+        for seq in distinct_seqs:
+            positions = profile_positions(
+                profile_scores,
+                gap_scores,
+                aligner.encode(seq),
+                args.insertion_penalty)
+            aligned = "".join(seq[j] if j >= 0 else "-" for j in positions)
+            for allele in seq_alleles[seq]:
+                print ">", allele
+                print aligned
+                f.write(">%s\n%s\n" % (allele, aligned))
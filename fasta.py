@@ -1,20 +1,36 @@
-def parse_fasta(s):
-    lines = s.split("\n")
-    lines = [l for l in lines if len(l) > 0]
+def iter_fasta(lines):
+    """
+    Generate (name, sequence) pairs from an iterable of FASTA lines such as
+    an open file, reading one record at a time. The name is the first word
+    of each header line.
+    """
+    name = None
+    parts = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(">"):
+            if name is not None:
+                yield name, "".join(parts)
+            name = line[1:].split(" ")[0]
+            parts = []
+        else:
+            parts.append(line)
+    if name is not None:
+        yield name, "".join(parts)
+
 
-    i = 0
-    d = {} 
-    curr_seq = ""
+def read_fasta(path):
+    """
+    Dictionary of sequences in a FASTA file, streamed from disk
+    """
+    with open(path) as f:
+        return dict(iter_fasta(f))
 
-    # parse FASTA file
-    while i < len(lines):
-        curr = lines[i]
-        i += 1
-        if curr.startswith(">"):
-            if curr_seq:
-                d[k] = curr_seq
-            k = curr[1:].split(" ")[0]
-            curr_seq = ""
-        elif curr:
-            curr_seq += curr
-    return d
\ No newline at end of file
+
+def parse_fasta(s):
+    """
+    Dictionary of sequences in a string holding the contents of a FASTA file
+    """
+    return dict(iter_fasta(s.splitlines()))
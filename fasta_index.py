@@ -0,0 +1,140 @@
+import argparse
+import os
+
+from parsing import allele_from_description, normalize_allele_name
+
+parser = argparse.ArgumentParser(
+    description=
+        'Build a byte offset index of an MHC FASTA file (like samtools '
+        'faidx) and optionally look up alleles through it'
+    )
+
+parser.add_argument(
+    "fasta_file",
+    help="FASTA file of MHC protein sequences",
+)
+
+parser.add_argument(
+    "--allele",
+    default="",
+    help="Comma separated alleles to print",
+)
+
+
+# not ".fai", the columns differ from a samtools faidx index
+INDEX_SUFFIX = ".mhcidx"
+
+
+def index_path_for(fasta_path):
+    return fasta_path + INDEX_SUFFIX
+
+
+def build_fasta_index(fasta_path, index_path=None):
+    """
+    Record the byte offset and size of each sequence in a FASTA file, keyed
+    by 4-digit allele name. Null and questionable (N/Q) alleles are skipped
+    and only the first record of each allele is used, as in
+    parse_fasta_mhc_files.
+    Writes a tab separated file of (allele, sequence length, offset, bytes)
+    and returns the entries as a dictionary.
+    """
+    if index_path is None:
+        index_path = index_path_for(fasta_path)
+    entries = {}
+    order = []
+
+    def add(allele, length, start, end):
+        if allele.endswith("N") or allele.endswith("Q"):
+            return
+        allele = normalize_allele_name(allele)
+        if allele not in entries:
+            order.append(allele)
+            entries[allele] = (length, start, end - start)
+
+    allele = None
+    with open(fasta_path, "rb") as f:
+        offset = 0
+        for line in f:
+            if line.startswith(">"):
+                if allele is not None:
+                    add(allele, length, start, offset)
+                allele = allele_from_description(line[1:].strip())
+                start = offset + len(line)
+                length = 0
+            else:
+                length += len(line.strip())
+            offset += len(line)
+        if allele is not None:
+            add(allele, length, start, offset)
+
+    with open(index_path, "w") as f:
+        for allele in order:
+            f.write("%s\t%d\t%d\t%d\n" % ((allele,) + entries[allele]))
+    return entries
+
+
+def load_fasta_index(index_path):
+    entries = {}
+    with open(index_path) as f:
+        for line in f:
+            allele, length, start, size = line.rstrip("\n").split("\t")
+            entries[allele] = (int(length), int(start), int(size))
+    return entries
+
+
+class IndexedFasta(object):
+    """
+    Random access to the sequences of an MHC FASTA file by allele name.
+    The index is built next to the FASTA file the first time it's needed
+    and rebuilt whenever the FASTA file is newer than it.
+    """
+
+    def __init__(self, fasta_path, index_path=None):
+        self.fasta_path = fasta_path
+        if index_path is None:
+            index_path = index_path_for(fasta_path)
+        self.index_path = index_path
+        if (not os.path.exists(index_path) or
+                os.path.getmtime(index_path) < os.path.getmtime(fasta_path)):
+            self.entries = build_fasta_index(fasta_path, index_path)
+        else:
+            self.entries = load_fasta_index(index_path)
+        self.f = open(fasta_path, "rb")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, allele):
+        return normalize_allele_name(allele) in self.entries
+
+    def __getitem__(self, allele):
+        length, start, size = self.entries[normalize_allele_name(allele)]
+        self.f.seek(start)
+        seq = "".join(self.f.read(size).split())
+        assert len(seq) == length, \
+            "Index %s is out of date for %s" % (
+                self.index_path, self.fasta_path)
+        return seq
+
+    def get(self, allele, default=None):
+        if allele in self:
+            return self[allele]
+        return default
+
+    def keys(self):
+        return self.entries.keys()
+
+    def close(self):
+        self.f.close()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    index = IndexedFasta(args.fasta_file)
+    print "%s: %d alleles indexed in %s" % (
+        args.fasta_file, len(index), index.index_path)
+    for allele in args.allele.split(","):
+        if allele:
+            print ">", allele
+            print index.get(allele)
+    index.close()
@@ -1,6 +1,9 @@
 import argparse
 import collections
 import math
+import os
+import time
+from os.path import exists
 
 import numpy as np
 
@@ -158,9 +161,98 @@ parser.add_argument(
     help="In addition to LogisticRegression also use LinearSVC"
 )
 
+parser.add_argument(
+    "--screen-auc-threshold",
+    default=None,
+    type=float,
+    help="Before training subset models, drop features whose single-feature "
+         "AUC is within this distance of 0.5"
+)
+
+parser.add_argument(
+    "--screen-downweight",
+    default=0.0,
+    type=float,
+    help="Instead of dropping features which fail screening, sample them "
+         "with this weight relative to features which pass"
+)
+
+parser.add_argument(
+    "--screen-block-size",
+    default=256,
+    type=int,
+    help="Number of feature columns to rank together during screening"
+)
+
+parser.add_argument(
+    "--redundancy-threshold",
+    default=None,
+    type=float,
+    help="Collapse groups of features whose absolute correlation is at least "
+         "this value into a single representative feature"
+)
+
+parser.add_argument(
+    "--redundancy-block-size",
+    default=512,
+    type=int,
+    help="Number of feature columns held in memory at once when computing "
+         "correlations"
+)
+
+parser.add_argument(
+    "--redundancy-mapping-file",
+    default="redundant_features.csv",
+    help="Where to write which representative each dropped feature maps to"
+)
+
+parser.add_argument(
+    "--feature-sampling",
+    default="random",
+    choices=["random", "blocks"],
+    help="Sample each iteration's features independently at random or as a "
+         "few contiguous blocks of features (fewer, larger reads)"
+)
+
+parser.add_argument(
+    "--feature-block-size",
+    default=64,
+    type=int,
+    help="Number of adjacent features in each block when using "
+         "--feature-sampling=blocks"
+)
+
+parser.add_argument(
+    "--feature-manifest",
+    default=None,
+    help="File with one feature name per line giving the order in which "
+         "features are grouped into blocks (default: the order their data "
+         "is stored in the file)"
+)
 
+parser.add_argument(
+    "--global-standardization",
+    default=False,
+    action="store_true",
+    help="Standardize every iteration with mean/std computed once over all "
+         "samples instead of recomputing them for each training subset"
+)
 
-def examine_features(f, feature_names):
+parser.add_argument(
+    "--feature-stats-file",
+    default=None,
+    help="npz file of per-feature mean/std (and bad columns) to reuse, "
+         "computed and written here if it doesn't exist yet"
+)
+
+
+
+def examine_features(f, feature_names, moments=None):
+    """
+    Check every feature for NaN/inf/constant values, returns set of
+    bad feature names. If a dictionary is given as `moments` then it's
+    filled with (mean, std) of each feature, computed in the same pass.
+    """
     bad_cols = set([])
     # checking features for NaN and infinite
     for i, feature_name in enumerate(sorted(feature_names)):
@@ -185,7 +277,10 @@ def examine_features(f, feature_names):
         nnz = (x!=0).sum()
         median = np.median(x)
         iqr = np.percentile(x, 75) - np.percentile(x, 25)
+        mean = np.mean(x)
         std = np.std(x)
+        if moments is not None:
+            moments[feature_name] = (mean, std)
         print "Feature %d/%d: %s (nnz=%d/%d, median=%s, iqr=%s, std=%s)" % (
             i + 1,
             n_features,
@@ -211,6 +306,244 @@ def examine_features(f, feature_names):
             bad_cols.add(feature_name)
     return bad_cols
 
+def feature_stats_source(input_file, min_feature_variance):
+    """
+    Identity of the inputs which a feature statistics file depends on:
+    the feature file (path, size and modification time) and the variance
+    threshold which decides the bad columns
+    """
+    stat = os.stat(input_file)
+    return np.array([
+        os.path.abspath(input_file),
+        repr(stat.st_size),
+        repr(stat.st_mtime),
+        repr(min_feature_variance),
+    ])
+
+def load_feature_stats(filename, source):
+    """
+    Load per-feature moments written by `save_feature_stats`, returns
+    dictionary of (mean, std) for each feature and set of bad features,
+    or None if the file was computed from a different `source`
+    """
+    data = np.load(filename)
+    if "source" not in data or list(data["source"]) != list(source):
+        return None
+    names = list(data["names"])
+    moments = dict(zip(names, zip(data["mean"], data["std"])))
+    bad_cols = set(name for (name, bad) in zip(names, data["bad"]) if bad)
+    return moments, bad_cols
+
+def save_feature_stats(filename, moments, bad_cols, source):
+    names = sorted(moments.keys())
+    np.savez(
+        filename,
+        names=np.array(names),
+        mean=np.array([moments[name][0] for name in names], dtype=float),
+        std=np.array([moments[name][1] for name in names], dtype=float),
+        bad=np.array([name in bad_cols for name in names], dtype=bool),
+        source=source)
+
+def standardized_columns(
+        f, feature_names, feature_indices, row_index_sets, mean, inv_std,
+        read_times=None):
+    """
+    Gather rows of the chosen features into preallocated float matrices
+    (one for each array of row indices), subtracting each column's global
+    mean and multiplying by its inverse global std as it's copied in.
+    Each column is read from the file only once, the time taken by each
+    read is appended to `read_times` if it's given.
+    """
+    Xs = [
+        np.empty((len(row_indices), len(feature_indices)), dtype=float)
+        for row_indices in row_index_sets
+    ]
+    for col_idx, feature_idx in enumerate(feature_indices):
+        start_time = time.time()
+        col = f[feature_names[feature_idx]][:]
+        if read_times is not None:
+            read_times.append(time.time() - start_time)
+        for X, row_indices in zip(Xs, row_index_sets):
+            np.subtract(
+                col[row_indices], mean[feature_idx], out=X[:, col_idx])
+            X[:, col_idx] *= inv_std[feature_idx]
+    return Xs
+
+def column_ranks(X):
+    """
+    Rank the values in each column of X (starting from 1), tied values
+    get the average of their ranks
+    """
+    n_rows, n_cols = X.shape
+    order = np.argsort(X, axis=0, kind="mergesort")
+    X_sorted = np.take_along_axis(X, order, axis=0)
+    row_idx = np.arange(n_rows)[:, np.newaxis]
+    # mark where each run of tied values starts and ends
+    run_start = np.ones(X.shape, dtype=bool)
+    run_start[1:] = X_sorted[1:] != X_sorted[:-1]
+    run_end = np.ones(X.shape, dtype=bool)
+    run_end[:-1] = run_start[1:]
+    first = np.maximum.accumulate(
+        np.where(run_start, row_idx, 0), axis=0)
+    last = np.minimum.accumulate(
+        np.where(run_end, row_idx, n_rows - 1)[::-1], axis=0)[::-1]
+    ranks = np.empty(X.shape, dtype=float)
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1, axis=0)
+    return ranks
+
+def univariate_aucs(f, feature_names, y, block_size=256):
+    """
+    ROC AUC of each feature used alone as a score for the binary target,
+    computed with the Mann-Whitney U statistic over blocks of columns
+    """
+    positive = y == np.max(y)
+    n_pos = positive.sum()
+    n_neg = len(y) - n_pos
+    aucs = np.zeros(len(feature_names), dtype=float)
+    for block_start in xrange(0, len(feature_names), block_size):
+        block_names = feature_names[block_start:block_start + block_size]
+        X = np.empty((len(y), len(block_names)), dtype=float)
+        for i, name in enumerate(block_names):
+            X[:, i] = f[name][:]
+        rank_sums = column_ranks(X)[positive].sum(axis=0)
+        u = rank_sums - n_pos * (n_pos + 1) / 2.0
+        aucs[block_start:block_start + len(block_names)] = \
+            u / float(n_pos * n_neg)
+        print "Screened %d/%d features" % (
+            block_start + len(block_names), len(feature_names))
+    return aucs
+
+def redundant_feature_representatives(
+        f, feature_names, moments, threshold, block_size=512):
+    """
+    Correlate every pair of features one block of columns at a time
+    and assign each feature to the first earlier feature which it's
+    correlated with (in absolute value) at least `threshold`. Returns
+    array with index of representative for each feature, features
+    which are their own representative are kept.
+    """
+    n_features = len(feature_names)
+    all_rows = np.arange(len(f[feature_names[0]]))
+    n_rows = float(len(all_rows))
+    mean = np.array([moments[name][0] for name in feature_names])
+    inv_std = 1.0 / np.array([moments[name][1] for name in feature_names])
+    representative = np.arange(n_features)
+
+    def load_block(indices):
+        return standardized_columns(
+            f, feature_names, indices, [all_rows], mean, inv_std)[0]
+
+    for i_start in xrange(0, n_features, block_size):
+        i_indices = np.arange(i_start, min(n_features, i_start + block_size))
+        X_i = load_block(i_indices)
+        # compare against representatives chosen in earlier blocks
+        for j_start in xrange(0, i_start, block_size):
+            j_indices = np.arange(j_start, j_start + block_size)
+            j_indices = j_indices[representative[j_indices] == j_indices]
+            unassigned = np.nonzero(representative[i_indices] == i_indices)[0]
+            if len(j_indices) == 0 or len(unassigned) == 0:
+                continue
+            X_j = load_block(j_indices)
+            corr = np.abs(X_j.T.dot(X_i[:, unassigned]) / n_rows)
+            hits = corr >= threshold
+            has_hit = hits.any(axis=0)
+            first_hit = hits.argmax(axis=0)
+            matched = unassigned[has_hit]
+            representative[i_indices[matched]] = \
+                j_indices[first_hit[has_hit]]
+        # then resolve duplicates within this block in feature order
+        corr = np.abs(X_i.T.dot(X_i) / n_rows)
+        for a in xrange(len(i_indices)):
+            if representative[i_indices[a]] != i_indices[a]:
+                continue
+            hits = corr[a, a + 1:] >= threshold
+            hits &= representative[i_indices[a + 1:]] == i_indices[a + 1:]
+            representative[i_indices[a + 1:][hits]] = i_indices[a]
+        print "Correlated %d/%d features, %d redundant so far" % (
+            i_indices[-1] + 1,
+            n_features,
+            (representative != np.arange(n_features)).sum())
+    return representative
+
+def contiguous_feature_blocks(order, n_features_per_iter, block_size):
+    """
+    Generate subsets of exactly `n_features_per_iter` features which are
+    each made of a few contiguous blocks of `order` (an array of feature
+    indices). On each pass over the features, `order` is cut into blocks
+    of `block_size` starting at a random offset (without wrapping around
+    the end) and the blocks are shuffled and dealt out in turn, splitting
+    a block between consecutive subsets where needed. Every feature is
+    used once per pass, so coverage stays balanced.
+    """
+    n_features = len(order)
+    assert 0 < n_features_per_iter <= n_features, \
+        "Can't sample %d of %d features" % (n_features_per_iter, n_features)
+
+    def shuffled_positions():
+        while True:
+            offset = np.random.randint(block_size)
+            starts = [0] + range(offset or block_size, n_features, block_size)
+            ends = starts[1:] + [n_features]
+            for b in np.random.permutation(len(starts)):
+                for position in xrange(starts[b], ends[b]):
+                    yield position
+
+    positions = shuffled_positions()
+    deferred = []
+    while True:
+        subset = []
+        chosen = set()
+        # a subset which straddles two passes can meet the same feature
+        # twice, those repeats are kept for the next subset instead
+        repeats = []
+        for position in deferred:
+            if len(subset) < n_features_per_iter and position not in chosen:
+                subset.append(position)
+                chosen.add(position)
+            else:
+                repeats.append(position)
+        while len(subset) < n_features_per_iter:
+            position = next(positions)
+            if position in chosen:
+                repeats.append(position)
+            else:
+                subset.append(position)
+                chosen.add(position)
+        deferred = repeats
+        yield order[np.array(subset)]
+
+def manifest_feature_order(feature_names, manifest_filename):
+    """
+    Indices of features in the order they're listed in a manifest file,
+    features missing from the manifest go last in their original order
+    """
+    feature_indices = dict(
+        (name, idx) for (idx, name) in enumerate(feature_names))
+    order = []
+    with open(manifest_filename) as manifest:
+        for line in manifest:
+            name = line.strip()
+            if name in feature_indices:
+                order.append(feature_indices.pop(name))
+    order.extend(sorted(feature_indices.values()))
+    return np.array(order)
+
+def storage_feature_order(f, feature_names):
+    """
+    Indices of features in the order their data is laid out in the file,
+    since h5py lists datasets by name rather than where they're stored
+    (so "x_10" comes before "x_2"). Datasets without a single contiguous
+    offset (chunked, or opened with PyTables) go last in name order.
+    """
+    offsets = []
+    for idx, name in enumerate(feature_names):
+        dataset = f[name]
+        offset = None
+        if hasattr(dataset, "id"):
+            offset = dataset.id.get_offset()
+        offsets.append((offset is None, offset, idx))
+    return np.array([idx for (_, _, idx) in sorted(offsets)])
+
 """
 Imitate the behavior of h5py for data generated by PyTables which
 can't be loaded with h5py
@@ -247,7 +580,7 @@ if __name__ == "__main__":
         f = PyTablesFile(args.input_file)
     else:
         import h5py
-        f = h5py.File(args.input_file)
+        f = h5py.File(args.input_file, "r")
 
 
     print "ARGUMENTS"
@@ -311,13 +644,87 @@ if __name__ == "__main__":
     n_samples_per_iter = int(n_samples * args.sample_fraction)
     n_features_per_iter = int(n_features * args.feature_fraction)
 
-    bad_cols = examine_features(f, feature_names)
+    stats_file = args.feature_stats_file
+    stats_source = feature_stats_source(
+        args.input_file, args.min_feature_variance)
+    feature_stats = None
+    if stats_file and exists(stats_file):
+        feature_stats = load_feature_stats(stats_file, stats_source)
+        if feature_stats is None:
+            print "Feature statistics in %s are for a different input " \
+                "file or --min-feature-variance, recomputing" % stats_file
+    if feature_stats is not None:
+        print "Loading feature statistics from %s" % stats_file
+        moments, bad_cols = feature_stats
+        missing = [name for name in feature_names if name not in moments]
+        assert len(missing) == 0, \
+            "Features missing from %s: %s" % (stats_file, missing)
+    else:
+        moments = {}
+        bad_cols = examine_features(f, feature_names, moments)
+        if stats_file:
+            print "Saving feature statistics to %s" % stats_file
+            save_feature_stats(stats_file, moments, bad_cols, stats_source)
 
     if len(bad_cols) > 0:
         feature_names = [x for x in feature_names if x not in bad_cols]
         n_features = len(feature_names)
         print "Bad columns: %s" % bad_cols
 
+    feature_weights = None
+    if args.screen_auc_threshold is not None:
+        aucs = univariate_aucs(
+            f, feature_names, y, block_size=args.screen_block_size)
+        pass_mask = np.abs(aucs - 0.5) >= args.screen_auc_threshold
+        print "Features passing AUC screen: %d / %d" % (
+            pass_mask.sum(), n_features)
+        assert pass_mask.sum() > 0, "No features passed AUC screening"
+        if args.screen_downweight > 0:
+            feature_weights = np.where(
+                pass_mask, 1.0, args.screen_downweight)
+            feature_weights /= feature_weights.sum()
+        else:
+            feature_names = [
+                name
+                for (name, passed) in zip(feature_names, pass_mask)
+                if passed
+            ]
+            n_features = len(feature_names)
+            n_features_per_iter = max(
+                1, int(n_features * args.feature_fraction))
+
+    if args.redundancy_threshold is not None:
+        representative = redundant_feature_representatives(
+            f,
+            feature_names,
+            moments,
+            args.redundancy_threshold,
+            block_size=args.redundancy_block_size)
+        keep_mask = representative == np.arange(n_features)
+        print "Dropping %d redundant features" % (~keep_mask).sum()
+        with open(args.redundancy_mapping_file, "w") as mapping_file:
+            mapping_file.write("feature,representative\n")
+            for (name, rep_idx) in zip(feature_names, representative):
+                if name != feature_names[rep_idx]:
+                    mapping_file.write(
+                        "%s,%s\n" % (name, feature_names[rep_idx]))
+        feature_names = [
+            name
+            for (name, keep) in zip(feature_names, keep_mask)
+            if keep
+        ]
+        if feature_weights is not None:
+            feature_weights = feature_weights[keep_mask]
+            feature_weights /= feature_weights.sum()
+        n_features = len(feature_names)
+        n_features_per_iter = max(1, int(n_features * args.feature_fraction))
+
+    if args.global_standardization:
+        global_mean = np.array(
+            [moments[name][0] for name in feature_names], dtype=float)
+        global_inv_std = 1.0 / np.array(
+            [moments[name][1] for name in feature_names], dtype=float)
+
     print "Samples per iter: %d / %d" % (n_samples_per_iter, n_samples)
     print "Features per iter: %d / %d" % (n_features_per_iter, n_features)
 
@@ -375,10 +782,35 @@ if __name__ == "__main__":
     else:
         n_iters = args.iters
 
+    if args.feature_sampling == "blocks":
+        assert feature_weights is None, \
+            "Can't combine --screen-downweight with block feature sampling"
+        if args.feature_manifest:
+            feature_order = manifest_feature_order(
+                feature_names, args.feature_manifest)
+        else:
+            feature_order = storage_feature_order(f, feature_names)
+        feature_blocks = contiguous_feature_blocks(
+            feature_order, n_features_per_iter, args.feature_block_size)
+
+    # keep track of how fast feature columns are read
+    column_nbytes = f[feature_names[0]][:].nbytes
+    total_bytes_read = 0
+    total_read_time = 0.0
+
     for i in xrange(n_iters):
-        np.random.shuffle(all_feature_indices)
         np.random.shuffle(all_sample_indices)
-        feature_indices = all_feature_indices[:n_features_per_iter]
+        if args.feature_sampling == "blocks":
+            feature_indices = next(feature_blocks)
+        elif feature_weights is None:
+            np.random.shuffle(all_feature_indices)
+            feature_indices = all_feature_indices[:n_features_per_iter]
+        else:
+            feature_indices = np.random.choice(
+                n_features,
+                n_features_per_iter,
+                replace=False,
+                p=feature_weights)
 
         training_indices = all_sample_indices[:n_samples_per_iter]
         testing_indices = \
@@ -408,22 +840,50 @@ if __name__ == "__main__":
         print "============"
         print
         print "-- Baseline accuracy for iter %0.4f" % baseline_acc
-        X_train = []
-        X_test = []
-        for feature_idx in feature_indices:
-            name = feature_names[feature_idx]
-            col = f[name][:]
-            train = col[training_indices]
-            test = col[testing_indices]
-            X_train.append(train)
-            X_test.append(test)
-        X_train = np.array(X_train, dtype=float).T
-        X_test = np.array(X_test, dtype=float).T
-        X_mean = X_train.mean(axis=0)
-        X_train -= X_mean
-        X_test -= X_mean
-        X_std = X_train.std(axis=0)
-        std_zero_mask = X_std < args.min_feature_variance
+        load_start = time.time()
+        read_times = []
+        if args.global_standardization:
+            X_train, X_test = standardized_columns(
+                f, feature_names, feature_indices,
+                [training_indices, testing_indices],
+                global_mean, global_inv_std,
+                read_times=read_times)
+            # features are already scaled, only need to find the ones
+            # which happen to be constant across the training rows
+            X_std = None
+            std_zero_mask = (X_train == X_train[0]).all(axis=0)
+        else:
+            X_train = []
+            X_test = []
+            for feature_idx in feature_indices:
+                name = feature_names[feature_idx]
+                read_start = time.time()
+                col = f[name][:]
+                read_times.append(time.time() - read_start)
+                train = col[training_indices]
+                test = col[testing_indices]
+                X_train.append(train)
+                X_test.append(test)
+            X_train = np.array(X_train, dtype=float).T
+            X_test = np.array(X_test, dtype=float).T
+            X_mean = X_train.mean(axis=0)
+            X_train -= X_mean
+            X_test -= X_mean
+            X_std = X_train.std(axis=0)
+            std_zero_mask = X_std < args.min_feature_variance
+        load_time = time.time() - load_start
+        # throughput only counts the column reads themselves, not the
+        # gathering of rows and standardization
+        read_time = sum(read_times)
+        bytes_read = len(feature_indices) * column_nbytes
+        total_read_time += read_time
+        total_bytes_read += bytes_read
+        print "-- Loaded %d features in %0.2fs, reads took %0.2fs " \
+            "(%0.2f MB/s)" % (
+                len(feature_indices),
+                load_time,
+                read_time,
+                bytes_read / 10.0**6 / max(read_time, 10.0**-9))
         std_zero_indices = np.nonzero(std_zero_mask)[0]
         # drop features with identical values across the sample
         if len(std_zero_indices) > 0:
@@ -438,7 +898,8 @@ if __name__ == "__main__":
             std_nonzero_mask = ~std_zero_mask
             X_train = X_train[:, std_nonzero_mask]
             X_test = X_test[:, std_nonzero_mask]
-            X_std = X_std[std_nonzero_mask]
+            if X_std is not None:
+                X_std = X_std[std_nonzero_mask]
 
 
             reduced_feature_indices = []
@@ -456,12 +917,13 @@ if __name__ == "__main__":
             feature_indices = reduced_feature_indices
 
             assert X_train.shape[1] == X_test.shape[1]
-            assert len(X_std) == X_train.shape[1]
+            assert X_std is None or len(X_std) == X_train.shape[1]
             assert len(feature_indices) == X_train.shape[1], \
                 "%d != %d" % (len(feature_indices), X_train.shape[1])
 
-        X_train /= X_std
-        X_test /= X_std
+        if X_std is not None:
+            X_train /= X_std
+            X_test /= X_std
 
         best_model = None
         best_accuracy = 0
@@ -550,6 +1012,13 @@ if __name__ == "__main__":
             feature_counts[name] += 1
             feature_values[name] += value * p
 
+    print
+    print "Column reads with %s sampling: %0.2f MB in %0.2fs (%0.2f MB/s)" % (
+        args.feature_sampling,
+        total_bytes_read / 10.0**6,
+        total_read_time,
+        total_bytes_read / 10.0**6 / max(total_read_time, 10.0**-9))
+
     # feature scores are average feature values
     feature_scores = collections.Counter()
     for name, v in feature_values.iteritems():
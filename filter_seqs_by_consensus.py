@@ -1,8 +1,8 @@
 import argparse
-import collections
 
-from parsing import parse_fasta_mhc_files
-from seq_helpers import positional_letter_counts, most_common_characters
+import numpy as np
+
+from parsing import parse_fasta_mhc_store
 
 parser = argparse.ArgumentParser(
     description=
@@ -28,23 +28,31 @@ parser.add_argument(
     type=float,
 )
 
+parser.add_argument(
+    "--seqs-cache-dir",
+    default=None,
+    help="Directory for caching parsed sequences between runs"
+)
+
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    seqs_dict = parse_fasta_mhc_files([args.input_file])
-    seqs = seqs_dict.values()
+    store = parse_fasta_mhc_store(
+        [args.input_file], cache_dir=args.seqs_cache_dir)
 
     # ensure all sequences are of correct length
-    n, consensus = most_common_characters(seqs)
-
+    consensus = store.consensus()
+    n = len(consensus)
+    matrix = store.matrix()
 
     # drop sequences which match less than 10% of the consensus residues
+    n_matches = (matrix == np.frombuffer(consensus, dtype=np.uint8)).sum(axis=1)
+    keep = n_matches >= args.fraction_match_required * n
     n_dropped = 0
     filtered_seqs = {}
-    for allele in sorted(seqs_dict.keys()):
-        seq = seqs_dict[allele]
-        n_match = sum(x == y for (x,y) in zip(seq, consensus))
-        if n_match < args.fraction_match_required * n:
+    for allele, seq, keep_seq in zip(store.names, matrix, keep):
+        seq = seq.tostring()
+        if not keep_seq:
             print "Dropping sequence %s: %s" % (allele, seq)
             n_dropped += 1
         else:
@@ -57,5 +65,5 @@ if __name__ == "__main__":
             f.write(">%s\n%s\n" % (allele, seq))
     print "---"
     print "CONSENSUS"
-    print "".join(consensus)
+    print consensus
 
@@ -1,6 +1,7 @@
 import argparse
 
 from parsing import  parse_fasta_mhc_files
+from allele_keys import AlleleIndex
 
 import h5py
 from pepdata import amino_acid, pmbec
@@ -82,6 +83,12 @@ parser.add_argument(
     help="Smallest variance in a feature for us to keep it",
 )
 
+parser.add_argument(
+    "--seqs-cache-dir",
+    default=None,
+    help="Directory for caching parsed sequences between runs"
+)
+
 AA_FEATURES = [
     'hydropathy',
     'volume',
@@ -129,11 +136,18 @@ if __name__ == "__main__":
     )
 
     binding_alleles = df_peptides[args.mhc_binding_allele_column]
-    mhc_seqs = parse_fasta_mhc_files([args.mhc_seqs_file])
+    mhc_seqs = parse_fasta_mhc_files(
+        [args.mhc_seqs_file], cache_dir=args.seqs_cache_dir)
+
+    # join binding data to MHC sequences through integer allele ids,
+    # normalizing each distinct allele name only once
+    allele_index = AlleleIndex(mhc_seqs.keys())
+    binding_ids = allele_index.ids(binding_alleles)
+    rows_by_id = pd.Series(binding_ids).groupby(binding_ids).indices
 
     print
     print "Missing allele sequences:", \
-        set(binding_alleles).difference(mhc_seqs.keys())
+        set(binding_alleles[binding_ids < 0])
 
 
     seq_pairs = []
@@ -148,9 +162,8 @@ if __name__ == "__main__":
 
         mhc_seq = mhc_seqs[allele]
 
-        mask = binding_alleles == allele
-        mask |= binding_alleles == allele.replace(":", "")
-        subset = df_peptides[mask]
+        subset = df_peptides.iloc[
+            rows_by_id.get(allele_index.get(allele), [])]
         count = len(subset)
         if count > 0:
             print allele, count
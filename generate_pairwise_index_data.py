@@ -10,6 +10,7 @@ import pandas as pd
 import logging
 
 from dataset_helpers import filter_dataframe, extract_columns
+from allele_keys import AlleleIndex
 
 logging.basicConfig(level=logging.INFO)
 import argparse
@@ -59,36 +60,42 @@ def generate_pairwise_index_data(
         extract_columns(df_peptides)
     print "%d unique peptide alleles" % len(peptide_alleles.unique())
 
-    mhc_alleles = df_mhc['Allele'].str.replace('*', '')
+    mhc_alleles = df_mhc['Allele']
     mhc_seqs = df_mhc['Residues']
 
     assert len(mhc_alleles) == len(df_mhc)
     assert len(mhc_seqs) == len(df_mhc)
 
+    # join peptides to MHC sequences through integer allele ids
+    allele_index = AlleleIndex()
+    mhc_ids = allele_index.ids(mhc_alleles, add=True)
+    peptide_ids = allele_index.ids(peptide_alleles)
+
     unique_alleles = set(peptide_alleles.unique())
     print list(sorted(unique_alleles))
     logging.info(
         "%d / %d available alleles",
-        len(set(mhc_alleles).intersection(unique_alleles)),
+        len(set(peptide_alleles[peptide_ids >= 0])),
         len(unique_alleles)
     )
     logging.info(
         "Missing allele sequences for %s",
-        list(sorted(unique_alleles.difference(set(mhc_alleles))))
+        list(sorted(set(peptide_alleles[peptide_ids < 0])))
     )
 
-    mhc_seqs_dict = {}
-    for allele, seq in zip(mhc_alleles, mhc_seqs):
-        mhc_seqs_dict[allele] = seq
+    mhc_seqs_by_id = {}
+    for allele_id, seq in zip(mhc_ids, mhc_seqs):
+        mhc_seqs_by_id[allele_id] = seq
     X = []
     Y_IC50 = []
     Y_category = []
     alleles = []
     n_dims = length * len(mhc_seqs[0])
-    for peptide_idx, allele in enumerate(peptide_alleles):
+    for peptide_idx, (allele, allele_id) in enumerate(
+            zip(peptide_alleles, peptide_ids)):
 
-        if allele in mhc_seqs_dict:
-            allele_seq = mhc_seqs_dict[allele]
+        if allele_id in mhc_seqs_by_id:
+            allele_seq = mhc_seqs_by_id[allele_id]
             peptide = peptide_seqs.ix[peptide_idx]
 
             n_peptide_letters = len(peptide)
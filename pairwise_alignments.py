@@ -1,10 +1,21 @@
 import sys 
 import argparse
+import collections
+import multiprocessing
 
+import numpy as np
 import nwalign as nw 
 
-from fasta import parse_fasta
+from fasta import read_fasta
+from alignment_cache import AlignmentCache
+from seq_helpers import group_by_sequence
+from reference_index import KmerReferenceIndex
 
+# increment whenever a change to this script changes alignment results
+ALIGNMENT_VERSION = 1
+GAP_OPEN = -40
+GAP_EXTEND = -20
+MATRIX = 'BLOSUM50'
 
 
 parser = argparse.ArgumentParser()
@@ -28,13 +39,285 @@ parser.add_argument(
     help = "Which allele to align against"
 )
 
+parser.add_argument(
+    "--reference-panel",
+    default = "",
+    type = str,
+    help = "Comma separated alleles to use as alternative references, each "
+           "sequence is aligned to whichever is most similar (by k-mer "
+           "sketch) and the result mapped onto --reference-allele"
+)
+
+parser.add_argument(
+    "--kmer-size",
+    default = 3,
+    type = int,
+    help = "Length of k-mers used to choose among --reference-panel alleles"
+)
+
+parser.add_argument(
+    "--cache-file",
+    default = None,
+    type = str,
+    help = "SQLite file of previous alignments to reuse (created if missing)"
+)
+
+parser.add_argument(
+    "--exact-band-width",
+    default = None,
+    type = int,
+    help = "Cross-check nwalign: align with an exact affine gap aligner "
+           "limited to this many positions around the diagonal instead "
+           "(redone with the full matrix if the best path reaches the edge "
+           "of the band). nwalign's gap recurrence isn't exact, so this "
+           "sometimes finds alignments which score higher under nwalign's "
+           "own scoring. It runs in NumPy and is about 10x slower than "
+           "nwalign, so it's not a way to speed alignment up"
+)
+
+parser.add_argument(
+    "--jobs",
+    default = 1,
+    type = int,
+    help = "Number of processes to align sequences with"
+)
+
+def read_ncbi_matrix(path):
+    """
+    Read a substitution matrix in the NCBI format used by nwalign,
+    returns dictionary of letter indices and 2D array of scores
+    """
+    rows = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                rows.append(line.split())
+    letters = rows[0]
+    scores = np.array(
+        [[float(v) for v in row[1:]] for row in rows[1:]], dtype=float)
+    assert scores.shape == (len(letters), len(letters)), \
+        "Malformed matrix file %s" % path
+    indices = dict((letter, i) for (i, letter) in enumerate(letters))
+    return indices, scores
+
+def banded_global_align(
+        refseq,
+        seq,
+        band_width,
+        letter_indices,
+        scores,
+        gap_open=GAP_OPEN,
+        gap_extend=GAP_EXTEND):
+    """
+    Affine gap global alignment of seq against refseq which only fills in
+    cells within `band_width` of the diagonals running from the start to
+    the end of both sequences. A gap of length L costs
+    gap_open + (L - 1) * gap_extend, as in nwalign. Unlike nwalign this
+    finds the best scoring path within the band, but every row takes a
+    dozen NumPy calls so it's about 10x slower than nwalign for MHC-length
+    sequences. Only meant for cross-checking nwalign's alignments.
+
+    Returns the position of seq (or -1 for a gap) aligned to each position
+    of refseq, or None if the best path touched the edge of the band.
+    """
+    assert gap_open <= gap_extend, \
+        "Banded alignment assumes opening a gap costs more than extending it"
+    n = len(refseq)
+    m = len(seq)
+    ref_idx = np.array([letter_indices[x] for x in refseq], dtype=int)
+    seq_idx = np.array([letter_indices[x] for x in seq], dtype=int)
+    # a band wider than the matrix is the same as the full matrix
+    lo_offset = max(-n, min(0, m - n) - band_width)
+    hi_offset = min(m, max(0, m - n) + band_width)
+    width = hi_offset - lo_offset + 1
+
+    # only the band is stored: cell (i, k) of each matrix is position
+    # (i, i + lo_offset + k) of the full matrix, so the diagonal step keeps
+    # k the same, a step down is k + 1 on the row above and a step right
+    # is k - 1. An extra column on the right stays -inf for the step down
+    # from the last band cell.
+    # M: refseq[i-1] aligned with seq[j-1]
+    # X: refseq[i-1] aligned with a gap
+    # Y: seq[j-1] aligned with a gap
+    M = np.full((n + 1, width + 1), -np.inf)
+    X = np.full((n + 1, width + 1), -np.inf)
+    Y = np.full((n + 1, width + 1), -np.inf)
+
+    # substitution scores of every band cell, looked up in one go
+    j = np.arange(n + 1)[:, np.newaxis] + lo_offset + np.arange(width)
+    in_matrix = (j >= 1) & (j <= m)
+    S = np.where(
+        in_matrix,
+        scores[
+            np.append(0, ref_idx)[:, np.newaxis],
+            seq_idx[np.clip(j - 1, 0, max(m - 1, 0))]] if m > 0 else 0,
+        -np.inf)
+    gap_steps = np.arange(width) * gap_extend
+
+    bounds = []
+    for i in xrange(n + 1):
+        lo = max(0, i + lo_offset)
+        hi = min(m, i + hi_offset)
+        bounds.append((lo, hi))
+        if lo > hi:
+            continue
+        k_lo = lo - i - lo_offset
+        k_hi = hi - i - lo_offset + 1
+        if i == 0:
+            M[0, k_lo] = 0
+        else:
+            above = i - 1
+            M[i, k_lo:k_hi] = np.maximum(
+                np.maximum(M[above, k_lo:k_hi], X[above, k_lo:k_hi]),
+                Y[above, k_lo:k_hi])
+            M[i, k_lo:k_hi] += S[i, k_lo:k_hi]
+            X[i, k_lo:k_hi] = np.maximum(
+                np.maximum(
+                    M[above, k_lo + 1:k_hi + 1],
+                    Y[above, k_lo + 1:k_hi + 1]) + gap_open,
+                X[above, k_lo + 1:k_hi + 1] + gap_extend)
+        # horizontal gaps start from an M or X cell to their left, the best
+        # start for every cell in the row comes from a running maximum
+        if k_hi - k_lo > 1:
+            steps = gap_steps[:k_hi - k_lo - 1]
+            opened = np.maximum(M[i, k_lo:k_hi - 1], X[i, k_lo:k_hi - 1])
+            opened -= steps
+            best_opened = np.maximum.accumulate(opened)
+            Y[i, k_lo + 1:k_hi] = best_opened + steps + gap_open
+
+    def on_band_edge(i, j):
+        lo, hi = bounds[i]
+        return (j == lo and lo > 0) or (j == hi and hi < m)
+
+    # trace back from the end, recording what's aligned to each ref position
+    aligned = []
+    i, j = n, m
+    k = m - n - lo_offset
+    end_scores = [M[n, k], X[n, k], Y[n, k]]
+    state = int(np.argmax(end_scores))
+    while i > 0 or j > 0:
+        if on_band_edge(i, j):
+            return None
+        if state == 0:
+            value = M[i, k] - S[i, k]
+            aligned.append(j - 1)
+            i -= 1
+            j -= 1
+            state = [M[i, k], X[i, k], Y[i, k]].index(value)
+        elif state == 1:
+            value = X[i, k]
+            aligned.append(-1)
+            i -= 1
+            k += 1
+            if value == X[i, k] + gap_extend:
+                state = 1
+            elif value == M[i, k] + gap_open:
+                state = 0
+            else:
+                state = 2
+        else:
+            value = Y[i, k]
+            j -= 1
+            k -= 1
+            if value == Y[i, k] + gap_extend:
+                state = 2
+            elif value == M[i, k] + gap_open:
+                state = 0
+            else:
+                state = 1
+    return np.array(aligned[::-1], dtype=int)
+
+def nw_aligned_positions(refseq, seq):
+    """
+    Globally align seq against refseq with nwalign, returns the position of
+    seq (or -1 for a gap) aligned to each position of refseq
+    """
+    x, y = nw.global_align(
+        refseq, seq, gap_open=GAP_OPEN, gap_extend=GAP_EXTEND, matrix=MATRIX)
+    positions = []
+    j = 0
+    for xi, yi in zip(x, y):
+        if xi != "-":
+            positions.append(j if yi != "-" else -1)
+        if yi != "-":
+            j += 1
+    return np.array(positions, dtype=int)
+
+def positions_to_string(seq, positions):
+    return "".join(seq[j] if j >= 0 else "-" for j in positions)
+
+def align_to_reference(refseq, seq):
+    """
+    Globally align seq against refseq and drop the positions which are
+    gaps in the reference
+    """
+    return positions_to_string(seq, nw_aligned_positions(refseq, seq))
+
+def aligned_positions(refseq, seq, band_width=None, matrix=None):
+    """
+    Align seq against refseq, with nwalign or, if a band width is given,
+    with a banded alignment using `matrix` (letter indices and scores from
+    `read_ncbi_matrix`). If the best banded path reaches the edge of the
+    band, it's redone with a band covering the whole matrix (so that both
+    cases use the same scoring). Returns positions of seq aligned to each
+    position of refseq and whether a full alignment was needed.
+    """
+    if band_width is None:
+        return nw_aligned_positions(refseq, seq), True
+    letter_indices, scores = matrix
+    positions = banded_global_align(
+        refseq, seq, band_width, letter_indices, scores)
+    if positions is not None:
+        return positions, False
+    full_width = len(refseq) + len(seq)
+    positions = banded_global_align(
+        refseq, seq, full_width, letter_indices, scores)
+    return positions, True
+
+# banding options and reference panel used by each worker process
+_worker_band_width = None
+_worker_matrix = None
+_worker_panel_seqs = None
+_worker_panel_positions = None
+
+def init_worker(band_width, panel_seqs, panel_positions):
+    """
+    Set up the options used by `align_seq` in this process,
+    `panel_positions` gives the positions of each panel sequence
+    which are aligned to the main reference.
+    """
+    global _worker_band_width, _worker_matrix
+    global _worker_panel_seqs, _worker_panel_positions
+    _worker_band_width = band_width
+    if band_width is not None:
+        _worker_matrix = read_ncbi_matrix(MATRIX)
+    _worker_panel_seqs = panel_seqs
+    _worker_panel_positions = panel_positions
+
+def align_seq(seq_and_panel_name):
+    """
+    Align seq against the chosen panel reference and map the result onto
+    the main reference. Returns the sequence, its alignment and whether it
+    needed a full alignment.
+    """
+    seq, panel_name = seq_and_panel_name
+    positions, used_full_alignment = aligned_positions(
+        _worker_panel_seqs[panel_name],
+        seq,
+        band_width=_worker_band_width,
+        matrix=_worker_matrix)
+    positions = np.append(positions, -1)
+    # -1 in the panel's own positions indexes the -1 appended above
+    mapped = positions[_worker_panel_positions[panel_name]]
+    return seq, positions_to_string(seq, mapped), used_full_alignment
+
 
 if __name__ == '__main__':
     args = parser.parse_args()
     print args
 
-    with open(args.input_filename,'r') as f:
-        d = parse_fasta(f.read())
+    d = read_fasta(args.input_filename)
 
     allele = args.reference_allele
 
@@ -43,14 +326,97 @@ if __name__ == '__main__':
     else:
         refseq = d[allele.replace("*", "")]
 
-    result = {}
-    for k,v in d.iteritems():
-        x, y = nw.global_align(refseq, v, gap_open=-40, gap_extend=-20, matrix='BLOSUM50')
-        good_positions = [i for i,xi in enumerate(x) if xi != "-"]
-        x_subset = "".join(x[i] for i in good_positions)
-        y_subset = "".join(y[i] for i in good_positions)
-        result[k] = y_subset
+    # each panel allele is aligned to the main reference once, sequences
+    # aligned against a panel allele get mapped through that alignment
+    panel_names = [allele] + [
+        name for name in args.reference_panel.split(",") if name]
+    matrix = None
+    if args.exact_band_width is not None:
+        matrix = read_ncbi_matrix(MATRIX)
+    panel_seqs = {}
+    panel_positions = {}
+    for name in panel_names:
+        panel_seq = d[name] if name in d else d[name.replace("*", "")]
+        panel_seqs[name] = panel_seq
+        panel_positions[name], _ = aligned_positions(
+            refseq, panel_seq, band_width=args.exact_band_width, matrix=matrix)
+    index = KmerReferenceIndex(panel_seqs, k=args.kmer_size)
+
+    cache = None
+    if args.cache_file:
+        if args.exact_band_width is None:
+            method = "full"
+        else:
+            method = "band=%d" % args.exact_band_width
+        cache = AlignmentCache(
+            args.cache_file,
+            "nwalign-v%d:%s:gap_open=%d:gap_extend=%d:%s" % (
+                ALIGNMENT_VERSION, MATRIX, GAP_OPEN, GAP_EXTEND, method))
+
+    # many alleles share a protein sequence, only align each one once
+    distinct_seqs, seq_alleles = group_by_sequence(d.iteritems())
+    print "%d alleles, %d distinct sequences (%0.2fx dedup)" % (
+        len(d),
+        len(distinct_seqs),
+        len(d) / float(max(len(distinct_seqs), 1)))
+
+    output_file = None
     if args.output_filename:
-        with open(args.output_filename, 'w') as f:
-            for k,v in result.iteritems():
-                f.write(">%s\n%s\n" % (k, v))
+        output_file = open(args.output_filename, 'w')
+
+    def write_alignment(seq, aligned):
+        if output_file is not None:
+            for k in seq_alleles[seq]:
+                output_file.write(">%s\n%s\n" % (k, aligned))
+            output_file.flush()
+
+    seq_panel_names = dict((v, index.nearest(v)) for v in distinct_seqs)
+    panel_counts = collections.Counter(seq_panel_names.values())
+    for name in sorted(panel_counts.keys()):
+        print "Reference %s: %d sequences" % (name, panel_counts[name])
+
+    def cache_ref(v):
+        """
+        Reference part of the cache key, includes the panel allele used
+        """
+        panel_name = seq_panel_names[v]
+        if panel_name == allele:
+            return refseq
+        return refseq + "/" + panel_seqs[panel_name]
+
+    not_cached = []
+    for v in distinct_seqs:
+        aligned = cache.get(cache_ref(v), v) if cache is not None else None
+        if aligned is None:
+            not_cached.append((v, seq_panel_names[v]))
+        else:
+            write_alignment(v, aligned)
+
+    worker_args = (args.exact_band_width, panel_seqs, panel_positions)
+    pool = None
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(
+            args.jobs, initializer=init_worker, initargs=worker_args)
+        results = pool.imap_unordered(align_seq, not_cached)
+    else:
+        init_worker(*worker_args)
+        results = (align_seq(item) for item in not_cached)
+
+    n_full = 0
+    for v, aligned, used_full_alignment in results:
+        n_full += used_full_alignment
+        if cache is not None:
+            cache.put(cache_ref(v), v, aligned)
+        write_alignment(v, aligned)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if output_file is not None:
+        output_file.close()
+    if args.exact_band_width is not None:
+        print "%d/%d sequences exceeded the band, used full alignment" % (
+            n_full, len(not_cached))
+    if cache is not None:
+        print cache.summary()
+        cache.close()
@@ -1,12 +1,22 @@
+import cPickle
+import hashlib
+import multiprocessing
+import os
+import time
+
 from immuno.common import find_paths
 from Bio.SeqIO.FastaIO import FastaIterator
 
+from sequence_store import SequenceStore, SequenceStoreBuilder
+
 
 def parse_fasta_mhc_dirs(
         dirs,
         min_length=0,
         exclude_allele_substrings=None,
-        require_allele_substrings=None):
+        require_allele_substrings=None,
+        processes=1,
+        cache_dir=None):
     paths = []
     for d in dirs:
         paths.extend(
@@ -17,48 +27,300 @@ def parse_fasta_mhc_dirs(
             paths,
             min_length=min_length,
             exclude_allele_substrings=exclude_allele_substrings,
-            require_allele_substrings=require_allele_substrings)
+            require_allele_substrings=require_allele_substrings,
+            processes=processes,
+            cache_dir=cache_dir)
 
-def parse_fasta_mhc_files(
-        paths,
+def allele_from_description(desc):
+    """
+    Allele name in the header of an MHC FASTA record, e.g.
+    "HLA:HLA00001 A*01:01:01:01 365 bp" gives "HLA-A*01:01:01:01"
+    """
+    fields = desc.split(" ")
+    if len(fields) ==1:
+        allele = fields[0]
+    else:
+        allele = fields[1]
+        if "-" not in allele and fields[0].startswith("HLA"):
+            allele = "HLA-" + allele
+    return allele
+
+def normalize_allele_name(allele):
+    """
+    Truncate an allele name to 4 digits, the level at which alleles
+    are expected to share a protein sequence
+    """
+    allele = allele.replace("_", "*")
+    return ":".join(allele.split(":")[:2])
+
+def filtered_allele(
+        desc,
+        exclude_allele_substrings=None,
+        require_allele_substrings=None):
+    """
+    Allele name of a FASTA record, or None if the record should be skipped
+    (null and questionable alleles, and the substring filters)
+    """
+    allele = allele_from_description(desc)
+    if allele.endswith("N") or allele.endswith("Q"):
+        return None
+    if exclude_allele_substrings and any(
+            exclude in allele
+            for exclude in exclude_allele_substrings):
+        return None
+    if require_allele_substrings and all(
+            substr not in allele
+            for substr in require_allele_substrings):
+        return None
+    return allele.replace("_", "*")
+
+def parse_fasta_mhc_file(
+        path,
         min_length=0,
         exclude_allele_substrings=[],
         require_allele_substrings=[]):
+    """
+    Parse MHC sequences from one FASTA file into a dictionary keyed by
+    4-digit allele name. Records of the same 4-digit allele are expected to
+    share a protein sequence, but some are partial, so the first record of
+    each allele is kept and the number of differing ones is printed.
+    """
     seqs = {}
+    n_conflicts = 0
+    with open(path, 'r') as f:
+        for record in FastaIterator(f):
+            allele = filtered_allele(
+                record.description,
+                exclude_allele_substrings,
+                require_allele_substrings)
+            if allele is None:
+                continue
+
+            seq = str(record.seq)
+            if len(seq) < min_length:
+                print "Skipping", allele, "length =", len(seq)
+                continue
+
+            allele = normalize_allele_name(allele)
+            if allele in seqs:
+                # expect all 4-digit alleles to correspond to the same
+                # protein sequence
+                if seqs[allele] != seq:
+                    n_conflicts += 1
+            else:
+                seqs[allele] = seq
+    if n_conflicts > 0:
+        print "%s: %d records differ from the first sequence of their " \
+            "4-digit allele, kept the first" % (path, n_conflicts)
+    return seqs
+
+def timed_parse_fasta_mhc_file(
+        (path, min_length, exclude_allele_substrings,
+         require_allele_substrings)):
+    start_time = time.time()
+    seqs = parse_fasta_mhc_file(
+        path,
+        min_length=min_length,
+        exclude_allele_substrings=exclude_allele_substrings,
+        require_allele_substrings=require_allele_substrings)
+    return path, seqs, time.time() - start_time
+
+# bump when the parsing rules change so old cache entries are ignored
+PARSED_SEQS_CACHE_VERSION = 2
+
+def parsed_seqs_cache_path(
+        cache_dir,
+        paths,
+        min_length,
+        exclude_allele_substrings,
+        require_allele_substrings,
+        extension=".pickle"):
+    """
+    Cache file for parsing these paths with these filters. The name depends
+    on the size and modification time of every input, so editing, adding or
+    removing a file gives a different entry.
+    """
+    key = [PARSED_SEQS_CACHE_VERSION, min_length]
+    key.append(sorted(exclude_allele_substrings or []))
+    key.append(sorted(require_allele_substrings or []))
     for path in paths:
-        with open(path, 'r') as f:
-            for record in FastaIterator(f):
-                desc = record.description
-                fields = desc.split(" ")
-                if len(fields) ==1:
-                    allele = fields[0]
-                else:
-                    allele = fields[1]
-                    if "-" not in allele and fields[0].startswith("HLA"):
-                        allele = "HLA-" + allele
-                if allele.endswith("N") or allele.endswith("Q"):
-                    continue
-                if exclude_allele_substrings and any(
-                        exclude in allele
-                        for exclude in exclude_allele_substrings):
-                    continue
-                if require_allele_substrings and all(
-                        substr not in allele
-                        for substr in require_allele_substrings):
-                    continue
-                allele = allele.replace("_", "*")
-
-                seq = str(record.seq)
-                if len(seq) < min_length:
-                    print "Skipping", allele, "length =", len(seq)
-                    continue
-
-                allele = ":".join(allele.split(":")[:2])
-                if allele in seq:
-                    # expect all 4-digit alleles to correspond to the same
-                    # protein sequence
-                    assert seqs[allele] == seq, (record, seq)
-                else:
-                    seqs[allele] = seq
+        stat = os.stat(path)
+        key.append((os.path.abspath(path), stat.st_size, stat.st_mtime))
+    return os.path.join(
+        cache_dir,
+        "mhc_seqs_%s%s" % (hashlib.sha1(repr(key)).hexdigest(), extension))
+
+def parse_fasta_mhc_files(
+        paths,
+        min_length=0,
+        exclude_allele_substrings=[],
+        require_allele_substrings=[],
+        processes=1,
+        cache_dir=None):
+    """
+    Parse MHC sequences from FASTA files into a dictionary keyed by
+    4-digit allele name. With processes > 1 the files are parsed in a
+    worker pool and the time taken by each one is printed. Results are
+    merged in the order of `paths` and, as within a file, the first
+    sequence of each allele is kept. Alleles which a later file gives a
+    different sequence are printed.
+
+    If cache_dir is given, the result is pickled there and reused by later
+    calls with the same filters for as long as none of the files change.
+    """
+    if cache_dir:
+        cache_path = parsed_seqs_cache_path(
+            cache_dir,
+            paths,
+            min_length,
+            exclude_allele_substrings,
+            require_allele_substrings)
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                return cPickle.load(f)
+
+    tasks = [
+        (path, min_length, exclude_allele_substrings, require_allele_substrings)
+        for path in paths
+    ]
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        results = pool.map(timed_parse_fasta_mhc_file, tasks)
+        pool.close()
+        pool.join()
+        for path, file_seqs, elapsed in results:
+            print "Parsed %s: %d sequences in %0.3fs" % (
+                path, len(file_seqs), elapsed)
+    else:
+        results = map(timed_parse_fasta_mhc_file, tasks)
+    seqs = {}
+    allele_paths = {}
+    for path, file_seqs, _ in results:
+        for allele, seq in file_seqs.iteritems():
+            if allele not in seqs:
+                seqs[allele] = seq
+                allele_paths[allele] = path
+            elif seqs[allele] != seq:
+                print "Different sequences for %s in %s and %s, kept the " \
+                    "first" % (allele, allele_paths[allele], path)
+
+    if cache_dir:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # write to a temporary name first so that an interrupted run
+        # doesn't leave a truncated entry behind
+        tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(seqs, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_path)
     return seqs
 
+def parse_fasta_mhc_file_into_store(
+        builder,
+        path,
+        min_length=0,
+        exclude_allele_substrings=None,
+        require_allele_substrings=None):
+    """
+    Add the MHC sequences of one FASTA file to a SequenceStoreBuilder,
+    writing residues straight into its buffer as lines are read. Follows
+    the rules of parse_fasta_mhc_file: records are compared with the first
+    record of their allele in this file. Returns the alleles which an
+    earlier file gave a different sequence.
+    """
+    # span of the first record of each allele in this file
+    file_spans = {}
+    changed_alleles = []
+    n_conflicts = 0
+
+    def finish(allele):
+        if allele is None:
+            return 0
+        length = builder.current_length()
+        if length < min_length:
+            print "Skipping", allele, "length =", length
+            builder.discard()
+            return 0
+        allele = normalize_allele_name(allele)
+        if allele in file_spans:
+            # expect all 4-digit alleles to correspond to the same
+            # protein sequence
+            conflict = not builder.spans_match(
+                file_spans[allele], builder.current_span())
+            builder.discard()
+            return conflict
+        span = file_spans[allele] = builder.finish()
+        if allele not in builder:
+            builder.keep(allele, span)
+        elif not builder.spans_match(builder.span(allele), span):
+            changed_alleles.append(allele)
+        return 0
+
+    allele = None
+    with open(path, 'r') as f:
+        for line in f:
+            if line[0] == ">":
+                n_conflicts += finish(allele)
+                allele = filtered_allele(
+                    line[1:].rstrip(),
+                    exclude_allele_substrings,
+                    require_allele_substrings)
+                if allele is not None:
+                    builder.start_sequence()
+            elif allele is not None:
+                builder.extend(
+                    line.rstrip().replace(" ", "").replace("\r", ""))
+        n_conflicts += finish(allele)
+    if n_conflicts > 0:
+        print "%s: %d records differ from the first sequence of their " \
+            "4-digit allele, kept the first" % (path, n_conflicts)
+    return changed_alleles
+
+def parse_fasta_mhc_store(
+        paths,
+        min_length=0,
+        exclude_allele_substrings=[],
+        require_allele_substrings=[],
+        cache_dir=None):
+    """
+    Like parse_fasta_mhc_files but returns a SequenceStore, filled in as the
+    files are read rather than converted from a dictionary of strings. If
+    cache_dir is given the store is saved there and memory mapped by later
+    calls with the same files and filters.
+    """
+    if cache_dir:
+        cache_path = parsed_seqs_cache_path(
+            cache_dir,
+            paths,
+            min_length,
+            exclude_allele_substrings,
+            require_allele_substrings,
+            extension=".store")
+        if os.path.exists(cache_path):
+            return SequenceStore.load(cache_path)
+
+    builder = SequenceStoreBuilder()
+    allele_paths = {}
+    changed = []
+    for path in paths:
+        changed_alleles = parse_fasta_mhc_file_into_store(
+            builder,
+            path,
+            min_length=min_length,
+            exclude_allele_substrings=exclude_allele_substrings,
+            require_allele_substrings=require_allele_substrings)
+        for allele in builder.names[len(allele_paths):]:
+            allele_paths[allele] = path
+        changed.extend((allele, path) for allele in changed_alleles)
+    for allele, path in changed:
+        print "Different sequences for %s in %s and %s, kept the " \
+            "first" % (allele, allele_paths[allele], path)
+    store = builder.build()
+
+    if cache_dir:
+        # as with the pickled dictionaries, write under a temporary name
+        # and rename once it's complete
+        tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        store.save(tmp_path)
+        os.rename(tmp_path, cache_path)
+    return store
@@ -20,6 +20,12 @@ parser.add_argument(
     type=float,
 )
 
+parser.add_argument(
+    "--seqs-cache-dir",
+    default=None,
+    help="Directory for caching parsed sequences between runs"
+)
+
 
 def positional_letter_counts(seqs, n):
     counters = []
@@ -34,7 +40,8 @@ def positional_letter_counts(seqs, n):
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    seqs_dict = parse_fasta_mhc_files([args.file])
+    seqs_dict = parse_fasta_mhc_files(
+        [args.file], cache_dir=args.seqs_cache_dir)
     seqs = seqs_dict.values()
 
     # ensure all sequences are of correct length
@@ -0,0 +1,78 @@
+import zlib
+
+import numpy as np
+
+# hash functions are (a * x + b) mod this prime
+MERSENNE_PRIME = 2 ** 31 - 1
+
+
+class KmerReferenceIndex(object):
+    """
+    MinHash sketches of the k-mers in a panel of reference sequences,
+    used to quickly pick the reference most similar to a query without
+    aligning it against every one of them.
+    """
+
+    def __init__(self, references, k=3, num_hashes=64, seed=0):
+        """
+        Parameters
+        ----------
+        references : dict
+            Reference sequences keyed by name
+
+        k : int
+            Length of k-mers
+
+        num_hashes : int
+            Number of hash functions (size of each sketch)
+
+        seed : int
+            Seed for choosing hash functions, sketches are only comparable
+            between indices built with the same seed
+        """
+        assert len(references) > 0, "Empty reference panel"
+        self.k = k
+        self.names = sorted(references.keys())
+        self.lengths = np.array(
+            [len(references[name]) for name in self.names])
+        random_state = np.random.RandomState(seed)
+        self.hash_a = random_state.randint(
+            1, MERSENNE_PRIME, size=num_hashes).astype(np.uint64)
+        self.hash_b = random_state.randint(
+            0, MERSENNE_PRIME, size=num_hashes).astype(np.uint64)
+        self.sketches = np.array(
+            [self.sketch(references[name]) for name in self.names])
+
+    def sketch(self, seq):
+        """
+        Minimum of each hash function over the distinct k-mers of seq
+        """
+        kmers = set(seq[i:i + self.k] for i in xrange(len(seq) - self.k + 1))
+        assert len(kmers) > 0, \
+            "Sequence shorter than k=%d: %s" % (self.k, seq)
+        kmer_hashes = np.array(
+            [zlib.crc32(kmer) & 0xffffffff for kmer in kmers],
+            dtype=np.uint64)[:, np.newaxis]
+        hashes = (kmer_hashes * self.hash_a + self.hash_b) % MERSENNE_PRIME
+        return hashes.min(axis=0)
+
+    def similarities(self, seq):
+        """
+        Estimated Jaccard similarity between the k-mers of seq and those
+        of each reference (in the order of self.names)
+        """
+        return (self.sketches == self.sketch(seq)).mean(axis=1)
+
+    def nearest(self, seq, max_length=None):
+        """
+        Name of the reference most similar to seq, optionally only
+        considering references no longer than `max_length`.
+        Returns None if no reference is short enough.
+        """
+        similarities = self.similarities(seq)
+        if max_length is not None:
+            similarities[self.lengths > max_length] = -1
+        best = np.argmax(similarities)
+        if similarities[best] < 0:
+            return None
+        return self.names[best]
@@ -1,5 +1,7 @@
 import collections
 
+import numpy as np
+
 def all_same_length(seqs):
     """
     Ensure all strings are of same length and
@@ -38,4 +40,48 @@ def most_common_characters(seqs):
     n = all_same_length(seqs)
     counters = positional_letter_counts(seqs, n)
     consensus = [c.most_common()[0][0]  for c in counters]
-    return n, consensus
\ No newline at end of file
+    return n, consensus
+
+
+def group_by_sequence(named_seqs):
+    """
+    Given (name, sequence) pairs, return the list of distinct sequences
+    (in order of first appearance) and a dictionary mapping each distinct
+    sequence to all of the names which share it
+    """
+    distinct = []
+    names = {}
+    for name, seq in named_seqs:
+        if seq not in names:
+            distinct.append(seq)
+            names[seq] = []
+        names[seq].append(name)
+    return distinct, names
+
+
+def start_offset_match_counts(seq, ref):
+    """
+    Given a sequence at least as long as a reference, count exact matches
+    between ref and seq[i:] for every start offset i from 0 to
+    len(seq) - len(ref). All offsets are counted at once by correlating
+    one-hot encodings of the two sequences with an FFT.
+    """
+    n_offsets = len(seq) - len(ref) + 1
+    assert n_offsets > 0, "Sequence shorter than reference"
+    seq_codes = np.frombuffer(seq, dtype=np.uint8)
+    ref_codes = np.frombuffer(ref, dtype=np.uint8)
+    letters = np.unique(ref_codes)[:, np.newaxis]
+    size = len(seq) + len(ref)
+    seq_spectrum = np.fft.rfft(seq_codes == letters, size)
+    ref_spectrum = np.fft.rfft(ref_codes == letters, size)
+    correlation = np.fft.irfft(
+        (seq_spectrum * np.conj(ref_spectrum)).sum(axis=0), size)
+    return np.rint(correlation[:n_offsets]).astype(int)
+
+
+def best_start_offset(seq, ref):
+    """
+    Start offset into seq which gives the most exact matches with ref,
+    ties go to the smallest offset
+    """
+    return int(np.argmax(start_offset_match_counts(seq, ref)))
@@ -0,0 +1,199 @@
+import os
+
+import numpy as np
+
+ARRAY_NAMES = ["names", "residues", "offsets", "lengths"]
+
+
+class SequenceStore(object):
+    """
+    Collection of named sequences held in one contiguous uint8 buffer of
+    residue codes, with the offset and length of each sequence. Names are
+    kept sorted and sequences are laid out in the same order, so when all
+    sequences have the same length (an alignment) the buffer can be viewed
+    as a 2-D matrix without copying.
+    """
+
+    def __init__(self, names, residues, offsets, lengths):
+        assert len(names) == len(offsets) == len(lengths), \
+            "Names, offsets and lengths differ in size"
+        self.names = names
+        self.residues = residues
+        self.offsets = offsets
+        self.lengths = lengths
+        self.index = dict((name, i) for (i, name) in enumerate(names))
+
+    @classmethod
+    def from_dict(cls, seqs):
+        names = sorted(seqs.keys())
+        lengths = np.array([len(seqs[name]) for name in names], dtype=np.int64)
+        offsets = np.zeros(len(names), dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)[:-1]
+        residues = np.frombuffer(
+            "".join(seqs[name] for name in names), dtype=np.uint8)
+        return cls(
+            np.array(names, dtype=str), residues, offsets, lengths)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        return self.codes(name).tostring()
+
+    def keys(self):
+        return list(self.names)
+
+    def iteritems(self):
+        for name in self.names:
+            yield name, self[name]
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def codes(self, name):
+        """
+        View of the residue codes of one sequence
+        """
+        i = self.index[name]
+        start = self.offsets[i]
+        return self.residues[start:start + self.lengths[i]]
+
+    def is_aligned(self):
+        return len(self) > 0 and (self.lengths == self.lengths[0]).all()
+
+    def matrix(self):
+        """
+        Residue codes of an aligned collection as a 2-D (sequences x
+        positions) view of the buffer, rows in the order of self.names
+        """
+        assert self.is_aligned(), "Sequences aren't all the same length"
+        n = len(self)
+        width = int(self.lengths[0])
+        start = int(self.offsets[0])
+        return self.residues[start:start + n * width].reshape((n, width))
+
+    def column_counts(self):
+        """
+        Number of occurrences of each residue code (0-255) at each position
+        of an aligned collection, shape (positions, 256)
+        """
+        m = self.matrix()
+        columns = np.arange(m.shape[1]) * 256
+        counts = np.bincount(
+            (m.astype(np.int64) + columns).ravel(),
+            minlength=256 * m.shape[1])
+        return counts.reshape((m.shape[1], 256))
+
+    def consensus(self):
+        """
+        Most common residue at each position of an aligned collection
+        """
+        return self.column_counts().argmax(axis=1).astype(np.uint8).tostring()
+
+    def save(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for array_name in ARRAY_NAMES:
+            np.save(
+                os.path.join(directory, array_name + ".npy"),
+                getattr(self, array_name))
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        Load a store written by save(), by default memory mapping the
+        arrays so that only the residues which get used are read
+        """
+        arrays = [
+            np.load(
+                os.path.join(directory, array_name + ".npy"),
+                mmap_mode="r" if mmap else None)
+            for array_name in ARRAY_NAMES
+        ]
+        return cls(*arrays)
+
+
+class SequenceStoreBuilder(object):
+    """
+    Collects sequences for a SequenceStore a line at a time into one
+    growing buffer, so that whole sequences never exist as Python strings.
+    Each sequence is started, extended with residues and then either
+    discarded or finished, which leaves it in the buffer and gives its
+    (offset, length) span. Kept spans stay in the order they were kept
+    until build() sorts them by name, others are left out.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.names = []
+        self.spans = []
+        self.index = {}
+        self.start = None
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def start_sequence(self):
+        self.start = len(self.buffer)
+
+    def extend(self, residues):
+        self.buffer.extend(residues)
+
+    def current_length(self):
+        return len(self.buffer) - self.start
+
+    def current_span(self):
+        return (self.start, self.current_length())
+
+    def discard(self):
+        del self.buffer[self.start:]
+        self.start = None
+
+    def finish(self):
+        span = self.current_span()
+        self.start = None
+        return span
+
+    def keep(self, name, span):
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        self.spans.append(span)
+
+    def span(self, name):
+        return self.spans[self.index[name]]
+
+    def spans_match(self, a, b):
+        """
+        Whether two finished sequences have the same residues
+        """
+        (a_offset, a_length), (b_offset, b_length) = a, b
+        return a_length == b_length and (
+            self.buffer[a_offset:a_offset + a_length] ==
+            self.buffer[b_offset:b_offset + b_length])
+
+    def build(self):
+        """
+        SequenceStore of the kept sequences. If they were kept in name
+        order and fill the buffer (e.g. a sorted alignment file) the store
+        is a view of the buffer, otherwise their residues are copied into
+        name order. Call it once, after the last sequence.
+        """
+        names = np.array(self.names, dtype=str)
+        order = np.argsort(names, kind="mergesort")
+        lengths = np.array(
+            [self.spans[i][1] for i in order], dtype=np.int64)
+        offsets = np.zeros(len(names), dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)[:-1]
+        buffer = np.frombuffer(self.buffer, dtype=np.uint8)
+        starts = np.array([self.spans[i][0] for i in order], dtype=np.int64)
+        if (starts == offsets).all() and lengths.sum() == len(buffer):
+            residues = buffer
+        else:
+            residues = np.empty(lengths.sum(), dtype=np.uint8)
+            for start, offset, length in zip(starts, offsets, lengths):
+                residues[offset:offset + length] = \
+                    buffer[start:start + length]
+        return SequenceStore(names[order], residues, offsets, lengths)